@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# Benchmarks and regression checks for the overhead of carafe itself
+# These don't need wine and don't touch the real "~/.carafe" folder
+# See README.md for more details and usage instructions
+
+import argparse
+import importlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+CARAFE_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+# Modules only needed by a few sub-commands, importing carafe should not load
+LAZY_MODULES = [
+    "asyncio", "concurrent.futures", "gzip", "hashlib", "multiprocessing",
+    "socket", "tarfile"]
+
+
+def import_times(home):
+    env = dict(os.environ)
+    env["HOME"] = home
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-X",
+         f"pycache_prefix={os.path.join(home, 'pycache')}",
+         "-c", "import carafe"],
+        cwd=CARAFE_FOLDER, env=env, stderr=subprocess.PIPE, text=True,
+        check=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            modules[name.strip()] = int(cumulative) / 1000
+    return modules
+
+
+def check_startup(args):
+    with tempfile.TemporaryDirectory() as home:
+        # An invalid config makes the import fail if it is read too early
+        os.makedirs(os.path.join(home, ".carafe"))
+        with open(os.path.join(home, ".carafe", "config.json"), "w",
+                  encoding="utf-8") as f:
+            f.write("invalid")
+        import_times(home)
+        runs = [import_times(home) for _ in range(args.runs)]
+    best = min(run["carafe"] for run in runs)
+    lazy = sorted({
+        module for run in runs for module in run for lazy in LAZY_MODULES
+        if module == lazy or module.startswith(f"{lazy}.")})
+    result = {
+        "import_ms": round(best, 2),
+        "max_import_ms": args.max_import_ms,
+        "eager_modules": lazy
+    }
+    print(json.dumps(result, indent=2))
+    if best > args.max_import_ms or lazy:
+        print("Startup regression: carafe imports too slowly or imports "
+              "modules that should be imported lazily", file=sys.stderr)
+        sys.exit(1)
+
+
+# Stub wine, which can create a minimal prefix and print lots of log output
+STUB_WINE = """#!/bin/sh
+case "$1" in
+    --version) echo "wine-0.0 (carafe benchmark stub)" ;;
+    wineboot) mkdir -p "$WINEPREFIX/drive_c/windows/system32" ;;
+    spam) yes "0024:fixme:d3d:wined3d_stub benchmark line" | head -c "$2" ;;
+esac
+"""
+STUB_WINETRICKS = """#!/bin/sh
+echo "winetricks $*"
+"""
+
+
+def write_stub(folder, name, contents):
+    location = os.path.join(folder, name)
+    with open(location, "w", encoding="utf-8") as f:
+        f.write(contents)
+    os.chmod(location, 0o755)
+    return location
+
+
+def generate_prefix(prefix, files, exe_density, seed=0):
+    # Roughly like a real prefix, 40% of the files are inside "windows"
+    rand = random.Random(seed)
+    drive_c = os.path.join(prefix, "drive_c")
+    windows_files = int(files * 0.4)
+    folders = [os.path.join(drive_c, "windows", "system32")]
+    for index in range(max(windows_files // 200, 1)):
+        folders.append(os.path.join(
+            drive_c, "windows", "winsxs", f"component{index}"))
+    for folder in folders:
+        os.makedirs(folder, exist_ok=True)
+    for index in range(windows_files):
+        folder = folders[index % len(folders)]
+        extension = "exe" if rand.random() < exe_density else "dll"
+        with open(os.path.join(folder, f"file{index}.{extension}"), "wb"):
+            pass
+    programs = []
+    for index in range(max((files - windows_files) // 100, 1)):
+        parts = [drive_c, "Program Files", f"Program{index % 50}"]
+        parts += [f"sub{rand.randrange(5)}" for _ in range(rand.randrange(4))]
+        programs.append(os.path.join(*parts))
+    for folder in programs:
+        os.makedirs(folder, exist_ok=True)
+    for index in range(files - windows_files):
+        folder = programs[index % len(programs)]
+        extension = "exe" if rand.random() < exe_density else "dat"
+        with open(os.path.join(folder, f"file{index}.{extension}"), "wb") as f:
+            f.write(b"MZ" * rand.randrange(1, 2048))
+    for hive in ["system.reg", "user.reg"]:
+        with open(os.path.join(prefix, hive), "w", encoding="utf-8") as f:
+            f.write("WINE REGISTRY Version 2\n")
+
+
+def best_of(runs, func, *args):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return round(min(timings), 6)
+
+
+def run_benchmarks(args):
+    home = tempfile.mkdtemp(prefix="carafe-benchmark-")
+    try:
+        results = benchmark_all(args, home)
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(f"{output}\n")
+    print(output)
+
+
+def benchmark_all(args, home):
+    config_folder = os.path.join(home, ".carafe")
+    bin_folder = os.path.join(home, "bin")
+    os.makedirs(config_folder)
+    os.makedirs(bin_folder)
+    wine = write_stub(bin_folder, "wine", STUB_WINE)
+    config = {
+        "wine": wine,
+        "winetricks": write_stub(bin_folder, "winetricks", STUB_WINETRICKS)
+    }
+    for index in range(args.carafes):
+        config[f"carafe{index}"] = {"arch": "win64", "link": "app.exe"}
+    with open(os.path.join(config_folder, "config.json"), "w",
+              encoding="utf-8") as f:
+        json.dump(config, f)
+    prefix = os.path.join(config_folder, "bench")
+    start = time.perf_counter()
+    generate_prefix(prefix, args.files, args.exe_density)
+    generate_time = time.perf_counter() - start
+    env = dict(os.environ)
+    env["HOME"] = home
+    carafe_script = os.path.join(CARAFE_FOLDER, "carafe.py")
+
+    def cli(*arguments):
+        subprocess.run(
+            [sys.executable, carafe_script, *arguments], env=env, check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    # The carafe module reads the home folder when imported
+    os.environ["HOME"] = home
+    sys.path.insert(0, CARAFE_FOLDER)
+    carafe = importlib.import_module("carafe")
+    bench = carafe.Carafe("bench")
+    results = {}
+
+    def list_executables():
+        return list(bench.list_executables())
+    start = time.perf_counter()
+    executables = list_executables()
+    results["list_executables_cold"] = round(time.perf_counter() - start, 6)
+    results["list_executables_indexed"] = best_of(args.runs, list_executables)
+
+    def list_after_install():
+        folder = os.path.join(prefix, "drive_c", "Program Files", "Program0")
+        with open(os.path.join(folder, f"new{time.time_ns()}.exe"), "wb"):
+            pass
+        list_executables()
+    results["list_executables_after_install"] = best_of(
+        args.runs, list_after_install)
+    results["cli_info"] = best_of(args.runs, cli, "bench", "info")
+    results["cli_list"] = best_of(args.runs, cli, "list")
+    results["cli_list_long"] = best_of(args.runs, cli, "list", "--long")
+    results["cli_help"] = best_of(args.runs, cli, "--help")
+    for mode in ["full", "reflink", "hardlink"]:
+        start = time.perf_counter()
+        cli("bench", "copy", f"bench-{mode}", "--mode", mode)
+        results[f"cli_copy_{mode}"] = round(time.perf_counter() - start, 6)
+    start = time.perf_counter()
+    cli("bench-full", "rename", "bench-renamed")
+    results["cli_rename"] = round(time.perf_counter() - start, 6)
+    for name in ["bench-renamed", "bench-reflink", "bench-hardlink"]:
+        start = time.perf_counter()
+        cli(name, "remove")
+        results[f"cli_remove_{name.split('-')[1]}"] = round(
+            time.perf_counter() - start, 6)
+
+    def config_mutations():
+        store = carafe.ConfigStore(carafe.CONFIG_FILE)
+        for index in range(args.carafes):
+            store.modify(f"carafe{index}", "link", f"app{index}.exe")
+        store.save()
+    results["config_mutations_batched"] = best_of(
+        args.runs, config_mutations)
+
+    def config_single_saves():
+        store = carafe.ConfigStore(carafe.CONFIG_FILE)
+        for index in range(min(args.carafes, 100)):
+            store.modify(f"carafe{index}", "arch", "win32")
+            store.save()
+    results["config_100_single_saves"] = best_of(
+        args.runs, config_single_saves)
+    log_size = args.log_mb * 1024 ** 2
+    log_time = best_of(
+        args.runs, bench.run_command, f"{wine} spam {log_size}", False)
+    results["run_command_log_seconds"] = log_time
+    results["run_command_log_mb_per_second"] = round(args.log_mb / log_time, 1)
+    return {
+        "carafe_version": carafe.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "files": args.files, "exe_density": args.exe_density,
+            "carafes": args.carafes, "runs": args.runs,
+            "log_mb": args.log_mb, "executables": len(executables),
+            "generate_seconds": round(generate_time, 3)
+        },
+        "results": results
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks and regression checks for carafe")
+    sub = parser.add_subparsers(dest="sub")
+    sub_startup = sub.add_parser(
+        "startup", help="Check the import time of carafe",
+        description="Check that importing carafe is fast, "
+                    "without reading the config or loading lazy modules")
+    sub_startup.add_argument(
+        "--runs", type=int, default=5,
+        help="Amount of imports to measure, the fastest one is used")
+    sub_startup.add_argument(
+        "--max-import-ms", type=float, default=50,
+        help="Maximum allowed import time of carafe in milliseconds")
+    sub_run = sub.add_parser(
+        "run", help="Run all benchmarks on a synthetic prefix",
+        description="Time the overhead of carafe commands using a stub wine "
+                    "and a generated prefix in a temporary folder")
+    sub_run.add_argument(
+        "--files", type=int, default=10000,
+        help="Amount of files in the generated drive_c, default is 10000")
+    sub_run.add_argument(
+        "--exe-density", type=float, default=0.02,
+        help="Fraction of the files that are executables, default is 0.02")
+    sub_run.add_argument(
+        "--carafes", type=int, default=200,
+        help="Amount of carafes in the generated config, default is 200")
+    sub_run.add_argument(
+        "--log-mb", type=int, default=200,
+        help="Amount of log output in MB to write through run_command")
+    sub_run.add_argument(
+        "--runs", type=int, default=3,
+        help="Amount of runs per benchmark, the fastest one is used")
+    sub_run.add_argument(
+        "-o", "--output", help="Also write the JSON results to this file")
+    args = parser.parse_args()
+    if args.sub == "startup":
+        check_startup(args)
+    elif args.sub == "run":
+        run_benchmarks(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
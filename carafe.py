@@ -10,12 +10,22 @@ __version__ = "1.7.0"
 # See https://github.com/jelmerro/carafe for repo and updates
 
 import argparse
-import glob
+import contextlib
+import fnmatch
+import io
 import json
 import os
+import re
+import shlex
 import shutil
 import subprocess
 import sys
+import time
+from collections import Counter, deque
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # MAIN CONFIG FOLDER LOCATION
 # If you really want to, you can change the folder location here
@@ -25,86 +35,2160 @@ CONFIG_FOLDER = os.path.join(os.path.expanduser("~"), ".carafe")
 # It's recommended to leave this path as is and only change the folder location
 CONFIG_FILE = os.path.join(CONFIG_FOLDER, "config.json")
 
+# TEMPLATE FOLDER LOCATION
+# Initialized prefixes that new carafes can be cloned from
+TEMPLATE_FOLDER = os.path.join(CONFIG_FOLDER, "templates")
+
+# DAEMON SOCKET LOCATION
+# Used by 'carafe daemon', commands are sent here when it is running
+DAEMON_SOCKET = os.path.join(CONFIG_FOLDER, "daemon.sock")
+
 
 # UTIL methods for small/common tasks
-def read_config():
-    if not os.path.isdir(CONFIG_FOLDER):
+def sanitize_name(name):
+    # Carafe names are folder names, so spaces and slashes are not allowed
+    return name.replace(" ", "").replace("/", "-")
+
+
+def carafe_names():
+    carafes = []
+    if os.path.isdir(CONFIG_FOLDER):
+        for item in sorted(os.listdir(CONFIG_FOLDER)):
+            if item == os.path.basename(TEMPLATE_FOLDER):
+                continue
+            if os.path.isdir(os.path.join(CONFIG_FOLDER, item)):
+                carafes.append(item)
+    return carafes
+
+
+def list_carafes(args):
+    parser = argparse.ArgumentParser(
+        prog="carafe list", usage="carafe list",
+        description="Use 'list' to show all carafes")
+    parser.add_argument(
+        "-l", "--long", action="store_true",
+        help="Show the size, file count, arch, wine, link and last use")
+    parser.add_argument(
+        "-s", "--sort", choices=["name", "size", "used"], default="name",
+        help="Order of the carafes in the long list")
+    args = parser.parse_args(args)
+    carafes = carafe_names()
+    if carafes and args.long:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor() as pool:
+            details = list(pool.map(carafe_details, carafes))
+        if args.sort == "size":
+            details.sort(key=lambda d: d["size"], reverse=True)
+        if args.sort == "used":
+            details.sort(key=lambda d: d["used"], reverse=True)
+        print(f"{'NAME':<20} {'SIZE':>9} {'FILES':>8} {'ARCH':<7} "
+              f"{'LAST USED':<16} {'WINE':<10} LINK")
+        for d in details:
+            used = "never"
+            if d["used"]:
+                used = time.strftime("%Y-%m-%d %H:%M", time.localtime(
+                    d["used"]))
+            print(f"{d['name']:<20} {format_size(d['size']):>9} "
+                  f"{d['count']:>8} {d['arch'] or 'default':<7} {used:<16} "
+                  f"{d['wine'] or 'default':<10} {d['link'] or ''}")
+    elif carafes:
+        print("The following carafes are currently configured:")
+        for carafe in carafes:
+            print(carafe)
+        print(f"Run '{sys.argv[0]} <carafe_name> info' for more information")
+    else:
+        print("There are currently no carafes configured")
+        print(f"Use '{sys.argv[0]} <carafe_name> create' to add a new carafe")
+    sys.exit(0)
+
+
+def format_size(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024:
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def folder_usage(prefix, folder, cached, sizes):
+    # Folders with an unchanged mtime reuse the cached totals of their files,
+    # the carafe folder itself is always listed, as the registry lives there
+    path = os.path.join(prefix, folder)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return 0, 0
+    mtime = stat.st_mtime_ns
+    entry = cached.get(folder)
+    if not entry or entry["mtime"] != mtime or not folder:
+        entry = {"mtime": mtime, "size": 0, "count": 0, "folders": []}
+        try:
+            with os.scandir(path) as entries:
+                for item in entries:
+                    try:
+                        if item.is_dir(follow_symlinks=False):
+                            entry["folders"].append(item.name)
+                        else:
+                            entry["size"] += item.stat(
+                                follow_symlinks=False).st_blocks * 512
+                            entry["count"] += 1
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+    sizes[folder] = entry
+    size, count = entry["size"] + stat.st_blocks * 512, entry["count"]
+    for sub in entry["folders"]:
+        sub_size, sub_count = folder_usage(
+            prefix, os.path.join(folder, sub), cached, sizes)
+        size += sub_size
+        count += sub_count
+    return size, count
+
+
+def carafe_details(name):
+    prefix = os.path.join(CONFIG_FOLDER, name)
+    cache_file = os.path.join(prefix, "sizes.json")
+    try:
+        with open(cache_file, encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = {}
+    sizes = {}
+    size, count = folder_usage(prefix, "", cached, sizes)
+    if sizes != cached:
+        try:
+            with open(f"{cache_file}.tmp", "w", encoding="utf-8") as f:
+                json.dump(sizes, f)
+            os.replace(f"{cache_file}.tmp", cache_file)
+        except OSError:
+            pass
+    used = 0
+    for hive in ["system.reg", "user.reg"]:
+        try:
+            used = max(used, os.stat(os.path.join(prefix, hive)).st_mtime)
+        except OSError:
+            pass
+    config = CONFIG.carafe(name)
+    return {
+        "name": name, "size": size, "count": count, "used": used,
+        "arch": config.get("arch"), "wine": config.get("wine"),
+        "link": config.get("link")
+    }
+
+
+def list_folder(path, mtime):
+    executables = []
+    folders = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.name)
+                    elif entry.name.lower().endswith(".exe"):
+                        if entry.is_file():
+                            executables.append(entry.name)
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return {"mtime": mtime, "exes": executables, "folders": folders}
+
+
+def walk_executables(drive_c, folder, excluded, cached, index):
+    # Folders with an unchanged mtime are taken from the index as is,
+    # only their subfolders are checked for changes, not the files in them
+    path = os.path.join(drive_c, folder)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return []
+    entry = cached.get(folder)
+    if not entry or entry["mtime"] != mtime:
+        entry = list_folder(path, mtime)
+    index[folder] = entry
+    executables = [os.path.join(folder, exe) for exe in entry["exes"]]
+    for sub in entry["folders"]:
+        sub = os.path.join(folder, sub)
+        if sub not in excluded:
+            executables.extend(
+                walk_executables(drive_c, sub, excluded, cached, index))
+    return executables
+
+
+def scan_executables(drive_c, excluded, cached, index):
+    # Folders are walked in parallel, but yielded in the same sorted order
+    # as a full path sort, so the first results can be shown right away
+    excluded = {os.path.normpath(e).strip(os.sep) for e in excluded}
+    try:
+        mtime = os.stat(drive_c).st_mtime_ns
+    except OSError:
+        return
+    root = cached.get("")
+    if not root or root["mtime"] != mtime:
+        root = list_folder(drive_c, mtime)
+    index[""] = root
+    folders = [f for f in root["folders"] if f not in excluded]
+    order = sorted([(f, False) for f in root["exes"]] + [
+        (f + os.sep, True) for f in folders])
+    folders = [f[:-1] for f, is_folder in order if is_folder]
+
+    def walk(folder):
+        folder_index = {}
+        executables = sorted(walk_executables(
+            drive_c, folder, excluded, cached, folder_index))
+        return executables, folder_index
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor() as pool:
+        results = pool.map(walk, folders)
+        for name, is_folder in order:
+            if is_folder:
+                executables, folder_index = next(results)
+                index.update(folder_index)
+                yield from executables
+            else:
+                yield name
+
+
+# Parsed indexes per carafe, reused by the daemon while they are unchanged
+INDEXES = {}
+
+
+def read_index(prefix):
+    index_file = os.path.join(prefix, "index.json")
+    try:
+        mtime = os.stat(index_file).st_mtime_ns
+        if prefix in INDEXES and INDEXES[prefix][0] == mtime:
+            return INDEXES[prefix][1]
+        with open(index_file, encoding="utf-8") as f:
+            INDEXES[prefix] = (mtime, json.load(f))
+        return INDEXES[prefix][1]
+    except (OSError, ValueError):
         return {}
-    if not os.path.isfile(CONFIG_FILE):
+
+
+def write_index(prefix, index):
+    index_file = os.path.join(prefix, "index.json")
+    try:
+        with open(f"{index_file}.tmp", "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(f"{index_file}.tmp", index_file)
+        INDEXES[prefix] = (os.stat(index_file).st_mtime_ns, index)
+    except OSError:
+        pass
+
+
+def find_executables(args):
+    parser = argparse.ArgumentParser(
+        prog="carafe find", usage="carafe find <pattern>",
+        description="Use 'find' to search the executables of all carafes")
+    parser.add_argument(
+        "pattern", help="Case-insensitive name or wildcard pattern to find")
+    pattern = parser.parse_args(args).pattern.lower()
+    if not any(char in pattern for char in "*?["):
+        pattern = f"*{pattern}*"
+    unindexed = []
+    for carafe in carafe_names():
+        index = read_index(os.path.join(CONFIG_FOLDER, carafe))
+        if "executables" not in index:
+            unindexed.append(carafe)
+            continue
+        for exe in index["executables"]:
+            if fnmatch.fnmatch(exe.lower(), pattern):
+                print(f"{carafe}: C:/{exe}")
+    if unindexed:
+        print("\nThe following carafes have not been indexed yet:")
+        for carafe in unindexed:
+            print(carafe)
+        print(f"Run '{sys.argv[0]} <carafe_name> info' to index them")
+    sys.exit(0)
+
+
+# Wine versions per binary, only asked again when the binary changed
+VERSIONS = {}
+
+
+def wine_version(wine):
+    key = None
+    location = shutil.which(wine)
+    if location:
+        try:
+            stat = os.stat(location)
+            key = f"{location}:{stat.st_size}:{stat.st_mtime_ns}"
+        except OSError:
+            pass
+    cache_file = os.path.join(CONFIG_FOLDER, "versions.json")
+    if key and not VERSIONS:
+        try:
+            with open(cache_file, encoding="utf-8") as f:
+                VERSIONS.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+    if key in VERSIONS:
+        return VERSIONS[key]
+    try:
+        version = subprocess.run(
+            f"{wine} --version", shell=True, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, text=True).stdout.strip()
+    except OSError:
+        return ""
+    if key and version:
+        # Older versions of the same binary are no longer needed
+        for old in [k for k in VERSIONS if k.startswith(f"{location}:")]:
+            del VERSIONS[old]
+        VERSIONS[key] = version
+        try:
+            with open(f"{cache_file}.tmp", "w", encoding="utf-8") as f:
+                json.dump(VERSIONS, f)
+            os.replace(f"{cache_file}.tmp", cache_file)
+        except OSError:
+            pass
+    return version
+
+
+def wineserver_for(wine):
+    # Custom wine builds ship their own wineserver right next to wine
+    location = shutil.which(wine)
+    if location:
+        wineserver = os.path.join(os.path.dirname(location), "wineserver")
+        if os.path.isfile(wineserver):
+            return wineserver
+    return "wineserver"
+
+
+def wine_dll_folders(wine, machine):
+    # Builtin dlls of wine itself, which programs load instead of the stubs
+    # in the prefix, the layout differs between distributions and builds
+    location = shutil.which(shlex.split(wine)[0]) if wine else None
+    if not location:
+        return []
+    arch = "i386" if machine == 0x14C else "x86_64"
+    folders = []
+    for binary in [location, os.path.realpath(location)]:
+        base = os.path.dirname(binary)
+        for sub in ["", "..", "../lib", "../lib64", "../lib/wine",
+                    "../lib64/wine", f"../lib/{arch}-linux-gnu/wine"]:
+            folder = os.path.normpath(
+                os.path.join(base, sub, f"{arch}-windows"))
+            if os.path.isdir(folder) and folder not in folders:
+                folders.append(folder)
+    return folders
+
+
+def preload_files(locations):
+    # Let the kernel read the files into the page cache, in parallel to
+    # keep many requests in flight on slow disks and network storage
+    def preload(location):
+        try:
+            fd = os.open(location, os.O_RDONLY)
+        except OSError:
+            return 0
+        try:
+            size = os.fstat(fd).st_size
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(fd, 0, size, os.POSIX_FADV_WILLNEED)
+            else:
+                while os.read(fd, 1024 ** 2):
+                    pass
+            return size
+        except OSError:
+            return 0
+        finally:
+            os.close(fd)
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor() as pool:
+        return sum(pool.map(preload, locations))
+
+
+def process_files(pid):
+    # Regular files mapped or opened by a process, such as loaded dlls
+    files = set()
+    try:
+        with open(f"/proc/{pid}/maps", encoding="utf-8",
+                  errors="replace") as f:
+            for line in f:
+                fields = line.split(maxsplit=5)
+                if len(fields) == 6 and fields[5].startswith("/"):
+                    files.add(fields[5].rstrip("\n"))
+        for fd in os.listdir(f"/proc/{pid}/fd"):
+            files.add(os.readlink(f"/proc/{pid}/fd/{fd}"))
+    except OSError:
+        pass
+    return {
+        f for f in files if not f.startswith(("/proc/", "/dev/", "/sys/"))
+        and os.path.isfile(f)}
+
+
+def template_location(wine, arch):
+    # Templates are only valid for the exact wine binary, version and arch
+    version = wine_version(wine)
+    key = f"{shutil.which(wine) or wine}\n{version}\n{arch or ''}"
+    import hashlib
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(TEMPLATE_FOLDER, f"{arch or 'default'}-{digest}")
+
+
+def manage_templates(args):
+    parser = argparse.ArgumentParser(
+        prog="carafe template", usage="carafe template {build,list,clear}",
+        description="Use 'template' to manage the prefixes used by "
+                    "'create --from-template'")
+    sub = parser.add_subparsers(dest="action")
+    sub_build = sub.add_parser(
+        "build", help="Build a template for the current wine version",
+        usage="carafe template build")
+    sub_build.add_argument(
+        "--arch", help="Change the default arch, e.g. to win32")
+    sub_build.add_argument(
+        "--wine", default=CONFIG.get("wine", WINE),
+        help="Custom wine location to use")
+    sub_build.add_argument(
+        "-f", "--force", action="store_true",
+        help="Rebuild the template even if it is up to date")
+    sub.add_parser(
+        "list", help="List all templates", usage="carafe template list")
+    sub.add_parser(
+        "clear", help="Remove all templates", usage="carafe template clear")
+    args = parser.parse_args(args)
+    if args.action == "build":
+        check_for_tool("wine", args.wine)
+        location = template_location(args.wine, args.arch)
+        if os.path.isdir(location) and not args.force:
+            print("The template for this wine version and arch is up to date")
+            sys.exit(0)
+        build = f"{location}.tmp"
+        shutil.rmtree(build, ignore_errors=True)
+        os.makedirs(build)
+        env = dict(os.environ)
+        env["WINEPREFIX"] = build
+        if args.arch:
+            env["WINEARCH"] = args.arch
+        with open(os.path.join(build, "log"), "wb") as output:
+            subprocess.run(
+                f"{args.wine} wineboot --init", shell=True, env=env,
+                stdout=output, stderr=output)
+            # Wait for the wineserver to finish writing the registry
+            subprocess.run(
+                f"{wineserver_for(args.wine)} -w", shell=True, env=env,
+                stdout=output, stderr=output)
+        os.remove(os.path.join(build, "log"))
+        shutil.rmtree(location, ignore_errors=True)
+        os.rename(build, location)
+        with open(f"{location}.json", "w", encoding="utf-8") as f:
+            json.dump({
+                "wine": shutil.which(args.wine) or args.wine,
+                "version": wine_version(args.wine),
+                "arch": args.arch
+            }, f)
+        print(f"Template built in '{location}'")
+    elif args.action == "list":
+        templates = []
+        if os.path.isdir(TEMPLATE_FOLDER):
+            templates = sorted(list_templates())
+        if not templates:
+            print("There are currently no templates")
+            print(f"Use '{sys.argv[0]} template build' to add one")
+        for name, info in templates:
+            print(f"{name}: {info.get('version')} "
+                  f"({info.get('arch') or 'default arch'}) {info.get('wine')}")
+    elif args.action == "clear":
+        shutil.rmtree(TEMPLATE_FOLDER, ignore_errors=True)
+    else:
+        parser.print_help()
+    sys.exit(0)
+
+
+def list_templates():
+    for item in os.listdir(TEMPLATE_FOLDER):
+        location = os.path.join(TEMPLATE_FOLDER, item)
+        if os.path.isdir(location) and not item.endswith(".tmp"):
+            try:
+                with open(f"{location}.json", encoding="utf-8") as f:
+                    yield item, json.load(f)
+            except (OSError, ValueError):
+                yield item, {}
+
+
+def sync_shortcuts(args):
+    parser = argparse.ArgumentParser(
+        prog="carafe shortcut-sync", usage="carafe shortcut-sync",
+        description="Use 'shortcut-sync' to keep a menu shortcut for the link "
+                    "and chosen executables of every carafe up to date")
+    parser.add_argument(
+        "-a", "--all", action="store_true",
+        help="Make a shortcut for all executables, not just the chosen ones")
+    parser.add_argument(
+        "-o", "--output-folder", default=os.path.join(os.environ.get(
+            "XDG_DATA_HOME", os.path.join(
+                os.path.expanduser("~"), ".local", "share")), "applications"),
+        help="Which folder to place the shortcuts, default is the menu")
+    args = parser.parse_args(args)
+    from concurrent.futures import ThreadPoolExecutor
+    shortcuts = {}
+    with ThreadPoolExecutor() as pool:
+        for entries in pool.map(
+                lambda name: Carafe(name).menu_shortcuts(args.all),
+                carafe_names()):
+            shortcuts.update(entries)
+    os.makedirs(args.output_folder, exist_ok=True)
+    written, removed = 0, 0
+    for item in os.listdir(args.output_folder):
+        location = os.path.join(args.output_folder, item)
+        if not item.startswith("carafe-") or not item.endswith(".desktop"):
+            continue
+        try:
+            with open(location, encoding="utf-8") as f:
+                contents = f.read()
+        except OSError:
+            continue
+        # Only shortcuts made by this command are updated or removed
+        if "\nX-Carafe=" not in contents:
+            shortcuts.pop(item, None)
+        elif item not in shortcuts:
+            os.remove(location)
+            removed += 1
+        elif shortcuts[item] == contents:
+            del shortcuts[item]
+    for item, contents in shortcuts.items():
+        location = os.path.join(args.output_folder, item)
+        with open(f"{location}.tmp", "w", encoding="utf-8") as f:
+            f.write(contents)
+        os.replace(f"{location}.tmp", location)
+        written += 1
+    print(f"Updated {written} and removed {removed} shortcut(s) in "
+          f"'{args.output_folder}'")
+    sys.exit(0)
+
+
+def extract_icon(exe, folder, name):
+    try:
+        with PEFile(exe) as pe:
+            extension, icon = pe.icon()
+    except (OSError, ValueError):
+        return None
+    if not icon:
+        return None
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, f"{name}{extension}"), "wb") as f:
+        f.write(icon)
+    return f"{name}{extension}"
+
+
+def read_pe_details(location):
+    try:
+        with PEFile(location) as pe:
+            return dict(pe.version(), bits=64 if pe.magic == 0x20B else 32,
+                        gui=pe.subsystem == 2)
+    except (OSError, ValueError):
         return {}
-    with open(CONFIG_FILE, encoding="utf-8") as f:
-        config = json.load(f)
-    if config == {}:
+
+
+def executable_tags(details):
+    if not details.get("bits"):
+        return ""
+    kind = "GUI" if details["gui"] else "console"
+    product = " ".join(
+        part for part in [details.get("product"), details.get("version")]
+        if part)
+    return f"[{details['bits']}-bit {kind}] {product}".rstrip()
+
+
+# Registry roots and the wine file and key they are stored in
+REG_ROOTS = {
+    "hkey_local_machine": ("system.reg", "", "HKEY_LOCAL_MACHINE"),
+    "hklm": ("system.reg", "", "HKEY_LOCAL_MACHINE"),
+    "hkey_current_user": ("user.reg", "", "HKEY_CURRENT_USER"),
+    "hkcu": ("user.reg", "", "HKEY_CURRENT_USER"),
+    "hkey_classes_root": (
+        "system.reg", "Software\\Classes", "HKEY_LOCAL_MACHINE"),
+    "hkcr": ("system.reg", "Software\\Classes", "HKEY_LOCAL_MACHINE")
+}
+
+
+def parse_reg_key(path):
+    parts = [part for part in re.split(r"[\\/]+", path) if part]
+    if not parts or parts[0].lower() not in REG_ROOTS:
+        raise CarafeError(
+            f"The key '{path}' should start with one of: "
+            "HKEY_LOCAL_MACHINE (HKLM), HKEY_CURRENT_USER (HKCU) or "
+            "HKEY_CLASSES_ROOT (HKCR)")
+    hive, base, root = REG_ROOTS[parts[0].lower()]
+    return hive, "\\".join(([base] if base else []) + parts[1:]), root
+
+
+def reg_escape(text):
+    escaped = ""
+    for char in text:
+        if char in "\\\"":
+            escaped += f"\\{char}"
+        elif char == "\n":
+            escaped += "\\n"
+        elif " " <= char < "\x7f":
+            escaped += char
+        else:
+            # Wine writes other characters as UTF-16 code units
+            units = char.encode("utf-16-le", "surrogatepass")
+            for index in range(0, len(units), 2):
+                escaped += "\\x{:04x}".format(
+                    int.from_bytes(units[index:index + 2], "little"))
+    return escaped
+
+
+def reg_unescape(text):
+    if "\\" not in text:
+        return text
+    escapes = {"n": "\n", "r": "\r", "t": "\t", "0": "\0"}
+    chars = []
+    index = 0
+    while index < len(text):
+        char = text[index]
+        index += 1
+        if char == "\\" and index < len(text):
+            char = text[index]
+            index += 1
+            digits = re.match(r"[0-9a-fA-F]{1,4}", text[index:])
+            if char == "x" and digits:
+                char = chr(int(digits.group(), 16))
+                index += len(digits.group())
+            else:
+                char = escapes.get(char, char)
+        chars.append(char)
+    # Characters written as two UTF-16 code units are combined again
+    return "".join(chars).encode("utf-16-le", "surrogatepass").decode(
+        "utf-16-le", "replace")
+
+
+def reg_lines(section):
+    # Lines of a section, with values spread over lines joined together
+    lines = []
+    raw = section.split("\n")
+    for line in raw[:-1] if section.endswith("\n") else raw:
+        if lines and lines[-1].endswith("\\") and not lines[-1].startswith(
+                ("[", "#", ";")):
+            lines[-1] = f"{lines[-1][:-1]}{line.strip()}"
+        else:
+            lines.append(line)
+    return lines
+
+
+def reg_data(data):
+    # Strings are shown unescaped, other types as written in the file
+    match = re.match(r'^(?:str\(\d+\):)?"(.*)"$', data, re.S)
+    if match:
+        return reg_unescape(match.group(1))
+    return data
+
+
+def dedup_carafes(args):
+    parser = argparse.ArgumentParser(
+        prog="carafe dedup", usage="carafe dedup",
+        description="Use 'dedup' to share identical files between all "
+                    "carafes and templates to save disk space")
+    parser.add_argument(
+        "-n", "--dry-run", action="store_true",
+        help="Only report the duplicates and the space that could be saved")
+    parser.add_argument(
+        "--min-size", type=int, default=4096,
+        help="Skip files smaller than this amount of bytes, default is 4096")
+    args = parser.parse_args(args)
+    folders = []
+    for name in carafe_names():
+        if Carafe(name).server_running():
+            print(f"Skipping {name}, because its wineserver is running")
+        else:
+            folders.append(os.path.join(CONFIG_FOLDER, name, "drive_c"))
+    if os.path.isdir(TEMPLATE_FOLDER):
+        for name, _ in list_templates():
+            folders.append(os.path.join(TEMPLATE_FOLDER, name, "drive_c"))
+    # Files are grouped per inode, so existing hardlinks are only hashed once
+    inodes = {}
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor() as pool:
+        for files in pool.map(
+                dedup_candidates, folders, [args.min_size] * len(folders)):
+            for path, stat in files:
+                key = f"{stat.st_dev}:{stat.st_ino}"
+                inodes.setdefault(key, (stat, []))[1].append(path)
+        sizes = {}
+        for key, (stat, _) in inodes.items():
+            sizes.setdefault((stat.st_dev, stat.st_size), []).append(key)
+        cache_file = os.path.join(CONFIG_FOLDER, "dedup.json")
+        try:
+            with open(cache_file, encoding="utf-8") as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+
+        def digest(key):
+            stat, paths = inodes[key]
+            entry = cache.get(key)
+            if entry and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+                return key, entry
+            try:
+                return key, [stat.st_size, stat.st_mtime_ns,
+                             hash_file(paths[0]), False]
+            except OSError:
+                return key, None
+        hashes = dict(pool.map(digest, [
+            key for keys in sizes.values() if len(keys) > 1 for key in keys]))
+    groups = {}
+    for key, entry in hashes.items():
+        if entry:
+            stat = inodes[key][0]
+            groups.setdefault(
+                (stat.st_dev, stat.st_size, entry[2]), []).append(key)
+    duplicates = 0
+    saved = 0
+    methods = Counter()
+    reflinks = {}
+    for keys in groups.values():
+        if len(keys) < 2:
+            continue
+        device = inodes[keys[0]][0].st_dev
+        if device not in reflinks:
+            reflinks[device] = reflink_supported(
+                os.path.dirname(min(inodes[keys[0]][1])))
+        # Inodes already reflinked by an earlier run keep sharing their data
+        keys.sort(key=lambda k: (not hashes[k][3], min(inodes[k][1])))
+        subgroups = [keys]
+        if not reflinks[device]:
+            # Hardlinks share permissions and changes, so only read-only
+            # files with the same mode and owner are linked to each other
+            linkable = {}
+            for key in keys:
+                stat = inodes[key][0]
+                if stat.st_mode & 0o222:
+                    linkable[key] = [key]
+                else:
+                    linkable.setdefault(
+                        (stat.st_mode, stat.st_uid), []).append(key)
+            subgroups = list(linkable.values())
+            duplicates += len(subgroups) - 1
+            methods[None] += len(subgroups) - 1
+        for subgroup in subgroups:
+            keeper = min(inodes[subgroup[0]][1])
+            for key in subgroup[1:]:
+                stat, paths = inodes[key]
+                if hashes[key][3]:
+                    continue
+                duplicates += 1
+                if args.dry_run:
+                    method = "dry-run"
+                else:
+                    method = dedup_inode(
+                        keeper, inodes[subgroup[0]][0], stat, paths)
+                methods[method] += 1
+                # The data is only freed once no other links point to it
+                if method and len(paths) == stat.st_nlink:
+                    saved += stat.st_blocks * 512
+                if method == "reflink":
+                    hashes[subgroup[0]][3] = True
+                    for path in paths:
+                        new = os.stat(path, follow_symlinks=False)
+                        hashes[f"{new.st_dev}:{new.st_ino}"] = [
+                            new.st_size, new.st_mtime_ns, hashes[key][2],
+                            True]
+                if method in ["reflink", "hardlink"]:
+                    hashes[key] = None
+    for key in inodes.keys() & cache.keys():
+        hashes.setdefault(key, cache[key])
+    cache = {key: entry for key, entry in hashes.items() if entry}
+    try:
+        with open(f"{cache_file}.tmp", "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+        os.replace(f"{cache_file}.tmp", cache_file)
+    except OSError:
+        pass
+    print(f"Found {duplicates} duplicate file(s) in {len(folders)} folder(s)")
+    if args.dry_run:
+        print(f"Deduplicating could save {format_size(saved)}")
+        if methods[None]:
+            print(f"{methods[None]} duplicate(s) can't be deduplicated, "
+                  "because reflinks are not supported and they are writable")
+    else:
+        print(f"Saved {format_size(saved)} with {methods['reflink']} "
+              f"reflink(s) and {methods['hardlink']} hardlink(s)")
+        if methods[None]:
+            print(f"{methods[None]} duplicate(s) were not deduplicated, "
+                  "because they changed, or because reflinks are not "
+                  "supported and they are writable")
+    sys.exit(0)
+
+
+def dedup_candidates(folder, min_size):
+    files = []
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        files += dedup_candidates(entry.path, min_size)
+                    elif entry.is_file(follow_symlinks=False):
+                        stat = entry.stat(follow_symlinks=False)
+                        if stat.st_size >= min_size:
+                            files.append((entry.path, stat))
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return files
+
+
+def hash_file(path):
+    import hashlib
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 ** 2), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def reflink_supported(folder):
+    # Tried once per filesystem, with two small files next to the duplicates
+    if fcntl is None:
+        return False
+    source = os.path.join(folder, ".carafe-reflink")
+    target = f"{source}-copy"
+    try:
+        with open(source, "wb") as f:
+            f.write(b"carafe")
+        with open(source, "rb") as src, open(target, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), PrefixCopier.FICLONE, src.fileno())
+        return True
+    except OSError:
+        return False
+    finally:
+        for path in [source, target]:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+
+
+def dedup_inode(keeper, keeper_stat, stat, paths):
+    # Replace all links of a duplicate inode, unless any file changed since
+    for path, expected in [(keeper, keeper_stat)] + [(p, stat) for p in paths]:
+        try:
+            current = os.stat(path, follow_symlinks=False)
+        except OSError:
+            return None
+        if (current.st_ino, current.st_size, current.st_mtime_ns) != (
+                expected.st_ino, expected.st_size, expected.st_mtime_ns):
+            return None
+    # Hardlinks share permissions and changes, so only for read-only files
+    # Wine, winetricks and patchers overwrite even dlls and exes in place
+    can_link = (stat.st_mode, stat.st_uid) == (
+        keeper_stat.st_mode, keeper_stat.st_uid) and \
+        not stat.st_mode & 0o222
+    method = None
+    for path in paths:
+        temp = f"{path}.carafe-dedup"
+        try:
+            if fcntl is not None and method != "hardlink":
+                try:
+                    with open(keeper, "rb") as src, open(temp, "wb") as dst:
+                        fcntl.ioctl(
+                            dst.fileno(), PrefixCopier.FICLONE, src.fileno())
+                    shutil.copystat(path, temp)
+                    os.replace(temp, path)
+                    method = "reflink"
+                    continue
+                except OSError:
+                    with contextlib.suppress(OSError):
+                        os.remove(temp)
+            if method == "reflink" or not can_link:
+                return None
+            os.link(keeper, temp)
+            os.replace(temp, path)
+            method = "hardlink"
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(temp)
+            return None
+    return method
+
+
+def gc_carafes(args):
+    parser = argparse.ArgumentParser(
+        prog="carafe gc", usage="carafe gc [<carafe_name> ...]",
+        description="Use 'gc' to report and remove temporary files, old logs, "
+                    "installer caches and shader caches of carafes")
+    parser.add_argument(
+        "names", nargs="*", help="Names of the carafes to clean up")
+    parser.add_argument(
+        "-a", "--all", action="store_true", help="Clean up all carafes")
+    parser.add_argument(
+        "-y", "--yes", action="store_true",
+        help="Actually remove the files instead of only reporting them")
+    args = parser.parse_args(args)
+    names = carafe_names() if args.all else args.names
+    if not names:
+        parser.print_help()
+        sys.exit(0)
+    for name in names:
+        Carafe(name).exists()
+    collect_garbage(names, args.yes)
+    sys.exit(0)
+
+
+def collect_garbage(names, delete):
+    rules = {}
+    for name in names:
+        carafe = Carafe(name)
+        if carafe.server_running():
+            print(f"Skipping {name}, because its wineserver is running")
+        else:
+            rules[name] = [
+                (category, [pattern.split("/") for pattern in patterns])
+                for category, patterns in carafe.read_setting(
+                    "gc_rules", GC_RULES).items()]
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor() as pool:
+        found = dict(zip(rules, pool.map(gc_scan, [
+            os.path.join(CONFIG_FOLDER, name) for name in rules],
+            rules.values())))
+        locations = [
+            location for entries in found.values() for _, location in entries]
+        sizes = dict(zip(locations, pool.map(disk_usage, locations)))
+        total = 0
+        for name, entries in found.items():
+            categories = dict.fromkeys(
+                [category for category, _ in rules[name]], 0)
+            for category, location in entries:
+                categories[category] += sizes[location]
+            total += sum(categories.values())
+            print(f"{name}: {format_size(sum(categories.values()))}")
+            for category, size in categories.items():
+                if size:
+                    print(f"  {category:<12} {format_size(size):>10}")
+        if not delete:
+            print(f"In total {format_size(total)} can be removed, "
+                  "run again with '--yes' to remove it")
+            return total
+        removed = dict(zip(locations, pool.map(gc_remove, locations)))
+    failed = sum(not success for success in removed.values())
+    total = sum(sizes[location] for location in locations
+                if removed[location])
+    print(f"Removed {format_size(total)} from {len(found)} carafe(s)")
+    if failed:
+        print(f"{failed} file(s) or folder(s) could not be removed")
+    return total
+
+
+def gc_match(parts, pattern, partial=False):
+    # Like fnmatch per folder without case, "**" matches any amount of
+    # folders and partial also accepts folders that could contain a match
+    if not parts:
+        return partial or not pattern or pattern == ["**"]
+    if not pattern:
+        return False
+    if pattern[0] == "**":
+        return gc_match(parts, pattern[1:], partial) or gc_match(
+            parts[1:], pattern, partial)
+    return fnmatch.fnmatch(parts[0].lower(), pattern[0].lower()) and \
+        gc_match(parts[1:], pattern[1:], partial)
+
+
+def gc_scan(prefix, rules, folder=()):
+    # Entries matching a rule, without entering folders that can't contain
+    # matches or following links, such as the drive letters of wine
+    found = []
+    try:
+        with os.scandir(os.path.join(prefix, *folder)) as entries:
+            items = list(entries)
+    except OSError:
+        return found
+    for item in items:
+        parts = folder + (item.name,)
+        category = next((category for category, patterns in rules if any(
+            gc_match(parts, pattern) for pattern in patterns)), None)
+        if category:
+            found.append((category, item.path))
+            continue
+        try:
+            is_dir = item.is_dir(follow_symlinks=False)
+        except OSError:
+            continue
+        if is_dir and any(gc_match(parts, pattern, True)
+                          for _, patterns in rules for pattern in patterns):
+            found += gc_scan(prefix, rules, parts)
+    return found
+
+
+def disk_usage(location):
+    # Allocated size of a file or a whole folder, without following links
+    size = 0
+    try:
+        size = os.lstat(location).st_blocks * 512
+        if os.path.isdir(location) and not os.path.islink(location):
+            with os.scandir(location) as entries:
+                for item in entries:
+                    size += disk_usage(item.path)
+    except OSError:
+        pass
+    return size
+
+
+def gc_remove(location):
+    try:
+        remove_location(location)
+        return True
+    except OSError:
+        return False
+
+
+def prefix_entries(prefix, folder=""):
+    # All folders, symlinks and files of a carafe except the logs, sorted
+    entries = []
+    with os.scandir(os.path.join(prefix, folder)) as items:
+        items = sorted(items, key=lambda item: item.name)
+    for item in items:
+        path = os.path.join(folder, item.name)
+        if fnmatch.fnmatch(path, "log") or fnmatch.fnmatch(path, "log.*"):
+            continue
+        stat = item.stat(follow_symlinks=False)
+        if item.is_symlink():
+            entries.append((path, "link", stat))
+        elif item.is_dir():
+            entries.append((path, "folder", stat))
+            entries += prefix_entries(prefix, path)
+        elif item.is_file():
+            entries.append((path, "file", stat))
+    return entries
+
+
+def add_json_member(tar, name, data):
+    import tarfile
+    data = json.dumps(data).encode()
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    tar.addfile(info, io.BytesIO(data))
+
+
+def export_trailer(offset):
+    # Empty gzip member with the manifest offset in an "extra" field,
+    # which gzip and tar ignore, so the manifest can be read without
+    # decompressing the entire export
+    return b"".join([
+        b"\x1f\x8b\x08\x04\0\0\0\0\0\xff", (12).to_bytes(2, "little"),
+        b"CM", (8).to_bytes(2, "little"), offset.to_bytes(8, "little"),
+        b"\x03\0", bytes(8)])
+
+
+def read_export_manifest(location):
+    import tarfile
+    import zlib
+    size = len(export_trailer(0))
+    try:
+        with open(location, "rb") as f:
+            f.seek(-size, os.SEEK_END)
+            trailer = f.read()
+            if trailer[:4] != b"\x1f\x8b\x08\x04" or trailer[12:14] != b"CM":
+                raise ValueError("not made by 'carafe export'")
+            f.seek(int.from_bytes(trailer[16:24], "little"))
+            data = f.read()[:-size]
+        raw = b""
+        while data:
+            decompressor = zlib.decompressobj(31)
+            raw += decompressor.decompress(data)
+            data = decompressor.unused_data
+        with tarfile.open(fileobj=io.BytesIO(raw)) as tar:
+            return json.load(tar.extractfile("manifest.json"))
+    except (OSError, ValueError, KeyError, zlib.error, tarfile.TarError) as e:
+        raise CarafeError(
+            f"The manifest of '{location}' could not be read: {e}") from e
+
+
+def import_location(target, path):
+    # Refuse paths that leave the carafe, also through symlinked folders
+    if not path or os.path.isabs(path) or ".." in path.split("/"):
+        return None
+    location = os.path.join(target, path)
+    root = os.path.realpath(target)
+    parent = os.path.realpath(os.path.dirname(location))
+    if parent != root and not parent.startswith(f"{root}{os.sep}"):
+        return None
+    return location
+
+
+def remove_location(location):
+    if os.path.isdir(location) and not os.path.islink(location):
+        shutil.rmtree(location)
+    elif os.path.lexists(location):
+        os.remove(location)
+
+
+def import_carafe(args):
+    parser = argparse.ArgumentParser(
+        prog="carafe import", usage="carafe import <file> [<carafe_name>]",
+        description="Use 'import' to restore a carafe from 'export', "
+                    "incremental exports are applied to the existing carafe")
+    parser.add_argument(
+        "file", help="Location of the export, or '-' to read from stdin")
+    parser.add_argument(
+        "name", nargs="?", help="Name of the carafe, default is the original")
+    args = parser.parse_args(args)
+    import gzip
+    import tarfile
+    import zlib
+    target = None
+    try:
+        source = sys.stdin.buffer
+        if args.file != "-":
+            source = open(args.file, "rb")
+        # Exports consist of many gzip members, which only gzip itself reads
+        with source, gzip.open(source) as stream, tarfile.open(
+                fileobj=stream, mode="r|") as tar:
+            member = tar.next()
+            if not member or member.name != "carafe.json":
+                raise ValueError("not made by 'carafe export'")
+            meta = json.load(tar.extractfile(member))
+            # The name in the export is not trusted to stay inside carafe
+            carafe = Carafe(sanitize_name(str(args.name or meta["name"])))
+            if meta["incremental"]:
+                carafe.exists()
+                prefix = carafe.prefix
+                for path in meta["deleted"]:
+                    location = import_location(prefix, path)
+                    if location:
+                        remove_location(location)
+            else:
+                name, prefix = carafe.check_new_name(carafe.name)
+                carafe = Carafe(name)
+                target = f"{prefix}.import"
+                shutil.rmtree(target, ignore_errors=True)
+                os.makedirs(target)
+            folders = []
+            for member in tar:
+                if not member.name.startswith("prefix/"):
+                    continue
+                location = import_location(
+                    target or prefix, member.name[len("prefix/"):])
+                if not location:
+                    print(f"Skipping unsafe path '{member.name}'")
+                    continue
+                if member.isdir():
+                    if not os.path.isdir(location) or os.path.islink(
+                            location):
+                        remove_location(location)
+                    os.makedirs(location, exist_ok=True)
+                    folders.append((location, member))
+                    continue
+                remove_location(location)
+                if member.issym():
+                    os.symlink(member.linkname, location)
+                elif member.isfile():
+                    with open(location, "wb") as f:
+                        shutil.copyfileobj(
+                            tar.extractfile(member), f, 1024 * 1024)
+                    os.chmod(location, member.mode)
+                    os.utime(location, (member.mtime, member.mtime))
+            for location, member in reversed(folders):
+                os.chmod(location, member.mode)
+                os.utime(location, (member.mtime, member.mtime))
+    except (OSError, ValueError, KeyError, EOFError, zlib.error,
+            tarfile.TarError) as e:
+        if target:
+            shutil.rmtree(target, ignore_errors=True)
+        raise CarafeError(f"The export could not be imported: {e}") from e
+    if target:
+        os.rename(target, prefix)
+    for field, value in meta["config"].items():
+        CONFIG.modify(carafe.name, field, value)
+    Carafe(carafe.name).update_index()
+    CONFIG.save()
+    print(f"Imported '{args.file}' as {carafe.name}")
+    sys.exit(0)
+
+
+# Wine debug lines look like "0024:fixme:d3d:function message"
+LOG_CHANNEL = re.compile(rb"^(?:[0-9a-f.]+:)*(err|warn|fixme|trace):(\w+):")
+
+
+def log_filter(grep=None, channels=None):
+    pattern = re.compile(grep.encode()) if grep else None
+    channels = [c.encode().split(b":") for c in channels or []]
+
+    def matches(line):
+        # Session headers separate the output of each command
+        if line.startswith(LogWriter.SESSION):
+            return True
+        if pattern and not pattern.search(line):
+            return False
+        if not channels:
+            return True
+        found = LOG_CHANNEL.match(line)
+        if not found:
+            return False
+        for channel in channels:
+            if len(channel) > 1:
+                if found.groups() == tuple(channel[:2]):
+                    return True
+            elif channel[0] in found.groups():
+                return True
+        return False
+    return matches
+
+
+def tail_lines(f, count, matches):
+    # Read blocks from the end until enough matching lines are found
+    position = f.seek(0, os.SEEK_END)
+    lines = []
+    remainder = b""
+    first = True
+    while position > 0 and len(lines) < count:
+        size = min(65536, position)
+        position -= size
+        f.seek(position)
+        parts = (f.read(size) + remainder).split(b"\n")
+        remainder = parts.pop(0)
+        if first and parts and parts[-1] == b"":
+            parts.pop()
+        first = False
+        for line in reversed(parts):
+            if len(lines) < count and matches(line):
+                lines.append(line + b"\n")
+    if position == 0 and len(lines) < count and remainder:
+        if matches(remainder):
+            lines.append(remainder + b"\n")
+    return reversed(lines)
+
+
+def log_segments(log_file):
+    # Rotated parts of a log, oldest first, an uncompressed part is used
+    # while its compressed copy might still be written
+    folder, name = os.path.split(log_file)
+    pattern = re.compile(rf"{re.escape(name)}\.(\d+)(\.gz|\.xz)?")
+    parts = {}
+    for item in os.listdir(folder):
+        found = pattern.fullmatch(item)
+        if found and (int(found[1]) not in parts or not found[2]):
+            parts[int(found[1])] = os.path.join(folder, item)
+    return [parts[number] for number in sorted(parts, reverse=True)]
+
+
+def open_segment(location):
+    if location.endswith(".gz"):
+        import gzip
+        return gzip.open(location, "rb")
+    if location.endswith(".xz"):
+        import lzma
+        return lzma.open(location, "rb")
+    return open(location, "rb", buffering=1024 * 1024)
+
+
+def session_segments(segments, active):
+    # The current session starts at the newest part with a session header
+    if active.readline().startswith(LogWriter.SESSION):
+        active.seek(0)
+        return []
+    active.seek(0)
+    for index in range(len(segments) - 1, -1, -1):
+        try:
+            with open_segment(segments[index]) as f:
+                if f.readline().startswith(LogWriter.SESSION):
+                    return segments[index:]
+        except (OSError, EOFError):
+            pass
+    return segments
+
+
+def log_lines(segments, active):
+    # Lines of all parts and then the active log, also when a line was
+    # split over two parts by the rotation
+    partial = b""
+    for location in [*segments, None]:
+        try:
+            with open_segment(location) if location else \
+                    contextlib.nullcontext(active) as f:
+                for line in f:
+                    if line.endswith(b"\n"):
+                        yield partial + line
+                        partial = b""
+                    else:
+                        partial += line
+        except (OSError, EOFError):
+            # Rotated away while reading, or not fully compressed yet
+            pass
+    if partial:
+        yield partial
+
+
+def percentile(values, percent):
+    # Nearest-rank percentile of an already sorted list
+    index = max(int(len(values) * percent / 100 + 0.5) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def check_for_tool(name, location):
+    if shutil.which(location):
+        return
+    lines = [f"\nThe required tool '{name}' could not be found"]
+    if location == name:
+        lines += [
+            "Please install it using your package manager",
+            "(Most required tools will be installed with wine)\n",
+            f"Or set a custom location in '{CONFIG_FILE}'",
+            "(You might need to create the file manually)",
+            f"(In the main object set '{name}' to the correct path)\n"]
+    else:
+        lines += [
+            "The path was manually changed in the config file",
+            f"The location is set to '{location}'",
+            f"Please remove the custom location from '{CONFIG_FILE}'",
+            f"Or update the path to the correct '{name}' location\n"]
+    raise ToolNotFound("\n".join(lines))
+
+
+# Errors of carafe operations, the CLI prints the message and exits
+class CarafeError(Exception):
+    pass
+
+
+class UnknownCarafe(CarafeError):
+    pass
+
+
+class InvalidName(CarafeError):
+    pass
+
+
+class LocationNotFound(CarafeError):
+    pass
+
+
+class ToolNotFound(CarafeError):
+    pass
+
+
+class CarafeRunning(CarafeError):
+    pass
+
+
+# Config store, the file is read once and changes are written in one go
+class ConfigStore:
+
+    def __init__(self, location):
+        self.location = location
+        self.lock_location = f"{location}.lock"
+        self.config = None
+        self.changes = []
+        self.mtime = None
+
+    def read(self):
+        if self.config is None:
+            with TIMINGS.measure("config load"):
+                self.config = self.read_file()
+        return self.config
+
+    def read_file(self):
+        try:
+            with open(self.location, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def refresh(self):
+        # Reload the config on the next read if another process changed it
+        try:
+            mtime = os.stat(self.location).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != self.mtime:
+            self.config = None
+            self.mtime = mtime
+
+    def get(self, field, default=None):
+        return self.read().get(field, default)
+
+    def carafe(self, name):
+        config = self.read().get(name)
+        if isinstance(config, dict):
+            return config
+        return {}
+
+    def modify(self, name, field, value):
+        self.apply(self.read(), ("modify", name, field, value))
+        self.changes.append(("modify", name, field, value))
+
+    def remove(self, name):
+        self.apply(self.read(), ("remove", name))
+        self.changes.append(("remove", name))
+
+    def rename(self, name, newname):
+        self.apply(self.read(), ("rename", name, newname))
+        self.changes.append(("rename", name, newname))
+
+    def apply(self, config, change):
+        if change[0] == "modify":
+            _, name, field, value = change
+            config.setdefault(name, {})[field] = value
+        elif change[0] == "rename":
+            _, name, newname = change
+            if name in config:
+                config[newname] = config.pop(name)
+        else:
+            config.pop(change[1], None)
+
+    def save(self):
+        # The changes are replayed on the latest version of the file,
+        # so parallel carafe commands don't overwrite each other's changes
+        if not self.changes:
+            return
+        os.makedirs(os.path.dirname(self.location), exist_ok=True)
+        with open(self.lock_location, "w", encoding="utf-8") as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            config = self.read_file()
+            for change in self.changes:
+                self.apply(config, change)
+            if config:
+                temp_location = f"{self.location}.{os.getpid()}.tmp"
+                with open(temp_location, "w", encoding="utf-8") as f:
+                    json.dump(config, f)
+                os.replace(temp_location, self.location)
+            else:
+                try:
+                    os.remove(self.location)
+                except OSError:
+                    pass
+        self.config = config
+        self.changes = []
+
+
+# Parallel copier for carafe folders, optionally using reflinks or hardlinks
+class PrefixCopier:
+
+    # Ioctl request number to share the data blocks of a file (btrfs/xfs)
+    FICLONE = 0x40049409
+
+    def __init__(self, source, target, mode="reflink", skip=()):
+        self.source = source
+        self.target = target
+        self.mode = mode
+        self.skip = skip
+        self.reflink = mode == "reflink" and fcntl is not None
+        self.files = []
+        self.folders = []
+        self.copied = 0
+        self.copied_bytes = 0
+        self.total_bytes = 0
+
+    def run(self, progress=True):
+        self.prepare("")
+        show_progress = progress and sys.stdout.isatty()
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor() as pool:
+            for size in pool.map(self.copy_file, self.files):
+                self.copied += 1
+                self.copied_bytes += size
+                if show_progress:
+                    print(f"\rCopying {self.copied}/{len(self.files)} files "
+                          f"({self.copied_bytes / 1024 ** 2:.0f}/"
+                          f"{self.total_bytes / 1024 ** 2:.0f} MB)", end="")
+        if show_progress:
+            print()
+        for folder in reversed(self.folders):
+            shutil.copystat(
+                os.path.join(self.source, folder),
+                os.path.join(self.target, folder), follow_symlinks=False)
+
+    def prepare(self, folder):
+        os.makedirs(os.path.join(self.target, folder))
+        self.folders.append(folder)
+        with os.scandir(os.path.join(self.source, folder)) as entries:
+            entries = list(entries)
+        for entry in entries:
+            path = os.path.join(folder, entry.name)
+            if any(fnmatch.fnmatch(path, skip) for skip in self.skip):
+                continue
+            if entry.is_symlink():
+                os.symlink(
+                    os.readlink(entry.path), os.path.join(self.target, path))
+            elif entry.is_dir():
+                self.prepare(path)
+            elif entry.is_file():
+                self.files.append(path)
+                self.total_bytes += entry.stat().st_size
+
+    def copy_file(self, path):
+        source = os.path.join(self.source, path)
+        target = os.path.join(self.target, path)
+        if self.mode == "hardlink":
+            # Wine and patchers overwrite even dlls and exes in place, so
+            # only read-only files are shared with hardlinks
+            try:
+                stat = os.stat(source)
+                if not stat.st_mode & 0o222:
+                    os.link(source, target)
+                    return stat.st_size
+            except OSError:
+                pass
+        if self.reflink:
+            try:
+                with open(source, "rb") as src, open(target, "wb") as dst:
+                    fcntl.ioctl(dst.fileno(), self.FICLONE, src.fileno())
+                shutil.copystat(source, target)
+                return os.stat(source).st_size
+            except OSError:
+                # Not supported by the filesystem, so stop trying
+                self.reflink = False
+        shutil.copy2(source, target)
+        return os.stat(source).st_size
+
+
+# Size limited log file, full parts are compressed in the background
+class LogWriter:
+
+    EXTENSIONS = {"gzip": ".gz", "xz": ".xz"}
+    # First line of every session, which always starts in a new part
+    SESSION = b"--- carafe: "
+
+    def __init__(self, location, max_size=0, segments=0, compression=None,
+                 title=""):
+        self.location = location
+        self.max_size = max_size
+        self.segments = segments
+        self.compression = compression
+        if max_size and not segments:
+            # Without parts, the last max_size is kept in two halves
+            self.max_size = max_size // 2
+            self.segments = 1
+            self.compression = None
+        self.extension = self.EXTENSIONS.get(self.compression, "")
+        self.compressor = None
+        self.size = 0
+        self.file = None
+        try:
+            previous = os.path.getsize(location)
+        except OSError:
+            previous = 0
+        if previous and self.segments:
+            # The end of the previous session is kept as the newest part
+            self.rotate()
+        else:
+            self.file = open(location, "wb", buffering=1024 * 1024)
+        started = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.write(
+            self.SESSION + f"{title.strip()} at {started} ---\n".encode())
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+        if self.max_size and self.size >= self.max_size:
+            self.rotate()
+
+    def rotate(self):
+        if self.file:
+            self.file.close()
+        if self.compressor:
+            self.compressor.join()
+        for number in range(self.segments, 0, -1):
+            segment = f"{self.location}.{number}{self.extension}"
+            if number == self.segments:
+                try:
+                    os.remove(segment)
+                except OSError:
+                    pass
+            elif os.path.exists(segment):
+                os.replace(
+                    segment, f"{self.location}.{number + 1}{self.extension}")
+        if self.segments:
+            os.replace(self.location, f"{self.location}.1")
+            if self.extension:
+                import threading
+                self.compressor = threading.Thread(
+                    target=self.compress, args=(f"{self.location}.1",))
+                self.compressor.start()
+        self.file = open(self.location, "wb", buffering=1024 * 1024)
+        self.size = 0
+
+    def compress(self, location):
+        if self.compression == "xz":
+            import lzma
+            output = lzma.open(f"{location}.xz", "wb", preset=1)
+        else:
+            import gzip
+            output = gzip.open(f"{location}.gz", "wb", compresslevel=1)
+        with open(location, "rb") as raw, output:
+            shutil.copyfileobj(raw, output, 1024 * 1024)
+        os.remove(location)
+
+    def close(self):
+        self.file.close()
+        if self.compressor:
+            self.compressor.join()
+
+
+# Gzip stream that compresses blocks as separate members on all cores
+class ParallelGzip:
+
+    BLOCK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, output):
+        from concurrent.futures import ThreadPoolExecutor
+        self.output = output
+        self.offset = 0
+        self.position = 0
+        self.buffer = bytearray()
+        self.pending = []
+        self.pool = ThreadPoolExecutor()
+        self.max_pending = 2 * (os.cpu_count() or 1)
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.BLOCK_SIZE:
+            self.submit(bytes(self.buffer[:self.BLOCK_SIZE]))
+            del self.buffer[:self.BLOCK_SIZE]
+        return len(data)
+
+    def submit(self, block):
+        import gzip
+        self.pending.append(self.pool.submit(
+            gzip.compress, block, compresslevel=6, mtime=0))
+        while len(self.pending) > self.max_pending:
+            self.write_member(self.pending.pop(0).result())
+
+    def write_member(self, member):
+        self.output.write(member)
+        self.offset += len(member)
+
+    def flush(self):
+        # Start a new gzip member, so the next data can be read separately
+        if self.buffer:
+            self.submit(bytes(self.buffer))
+            self.buffer.clear()
+        for pending in self.pending:
+            self.write_member(pending.result())
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.pool.shutdown()
+
+
+# File wrapper that hashes all data that is read from it
+class HashingReader:
+
+    def __init__(self, file):
+        import hashlib
+        self.file = file
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.digest.update(data)
+        return data
+
+
+# Minimal reader for the headers and resources of windows executables,
+# the file is mapped into memory so only the parts that are used are read
+class PEFile:
+
+    RT_ICON = 3
+    RT_GROUP_ICON = 14
+    RT_VERSION = 16
+
+    def __init__(self, location):
+        import mmap
+        with open(location, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            header = self.u32(0x3C)
+            if self.data[:2] != b"MZ" or self.data[header:header + 4] != \
+                    b"PE\0\0":
+                raise ValueError("not a windows executable")
+            self.machine = self.u16(header + 4)
+            sections = self.u16(header + 6)
+            optional = header + 24
+            self.magic = self.u16(optional)
+            self.subsystem = self.u16(optional + 68)
+            self.directories = optional + (
+                112 if self.magic == 0x20B else 96)
+            self.sections = []
+            table = optional + self.u16(header + 20)
+            for index in range(sections):
+                section = table + index * 40
+                self.sections.append((
+                    self.u32(section + 12), max(self.u32(section + 8),
+                                                self.u32(section + 16)),
+                    self.u32(section + 20)))
+            self.resource_base = self.offset(
+                self.u32(self.directories + 16))
+        except (ValueError, IndexError):
+            self.close()
+            raise ValueError("not a windows executable")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_args):
+        self.close()
+
+    def close(self):
+        self.data.close()
+
+    def u16(self, offset):
+        return int.from_bytes(self.data[offset:offset + 2], "little")
+
+    def u32(self, offset):
+        return int.from_bytes(self.data[offset:offset + 4], "little")
+
+    def offset(self, rva):
+        for address, size, raw in self.sections:
+            if address <= rva < address + size:
+                return rva - address + raw
+        return None
+
+    def imports(self):
+        # Names of the dlls in the import and delay import tables
+        names = []
+        count = self.u32(self.directories - 4)
+        for entry, size, name in [(1, 20, 12), (13, 32, 4)]:
+            if entry >= count:
+                continue
+            offset = self.offset(self.u32(self.directories + entry * 8))
+            for _ in range(4096):
+                if offset is None or not self.u32(offset + name):
+                    break
+                # Old delay imports use addresses instead of offsets
+                if entry == 1 or self.u32(offset) & 1:
+                    start = self.offset(self.u32(offset + name))
+                    if start is not None:
+                        end = self.data.find(b"\0", start, start + 256)
+                        names.append(self.data[start:end].decode(
+                            "ascii", "replace").lower())
+                offset += size
+        return names
+
+    def directory(self, offset):
+        # Entries of a resource directory as (id, offset, is_directory)
+        count = self.u16(offset + 12) + self.u16(offset + 14)
+        entries = []
+        for index in range(min(count, 4096)):
+            entry = offset + 16 + index * 8
+            target = self.u32(entry + 4)
+            entries.append((
+                self.u32(entry), self.resource_base + (target & 0x7FFFFFFF),
+                bool(target & 0x80000000)))
+        return entries
+
+    def resources(self, kind):
+        # Data of each resource of a type, in the first language found
+        if self.resource_base is None:
+            return []
+        found = []
+        for ident, offset, is_directory in self.directory(self.resource_base):
+            if ident != kind or not is_directory:
+                continue
+            # Exactly three levels: type, name and language, so malformed
+            # directories that point to themselves can't loop forever
+            for name, sub, is_sub_directory in self.directory(offset):
+                if not is_sub_directory:
+                    continue
+                languages = self.directory(sub)
+                if not languages or languages[0][2]:
+                    continue
+                sub = languages[0][1]
+                start = self.offset(self.u32(sub))
+                if start is not None:
+                    found.append((name, self.data[
+                        start:start + self.u32(sub + 4)]))
+        return found
+
+    def version(self):
+        # Product name and version from the VERSIONINFO resource
+        resources = self.resources(self.RT_VERSION)
+        if not resources:
+            return {}
+        data = resources[0][1]
+        fixed = ""
+        strings = {}
+        for _, value, children in self.version_blocks(data, 0, len(data)):
+            if len(value) >= 24 and value[:4] == b"\xbd\x04\xef\xfe":
+                ms = int.from_bytes(value[16:20], "little")
+                ls = int.from_bytes(value[20:24], "little")
+                fixed = f"{ms >> 16}.{ms & 0xFFFF}.{ls >> 16}.{ls & 0xFFFF}"
+            for key, _, tables in self.version_blocks(data, *children):
+                if key != "StringFileInfo":
+                    continue
+                for _, _, table in self.version_blocks(data, *tables)[:1]:
+                    for name, text, _ in self.version_blocks(data, *table):
+                        strings[name] = text.decode(
+                            "utf-16-le", "replace").split("\0")[0].strip()
+        return {
+            "product": strings.get("ProductName")
+            or strings.get("FileDescription") or "",
+            "version": strings.get("ProductVersion")
+            or strings.get("FileVersion") or fixed
+        }
+
+    @staticmethod
+    def version_blocks(data, start, end):
+        # Blocks of the version resource as (key, value, children range)
+        blocks = []
+        while start + 6 <= end:
+            length = int.from_bytes(data[start:start + 2], "little")
+            size = int.from_bytes(data[start + 2:start + 4], "little")
+            if length < 6:
+                break
+            if data[start + 4:start + 6] == b"\1\0":
+                size *= 2
+            block_end = min(start + length, end)
+            key_end = start + 6
+            while key_end + 1 < block_end and \
+                    data[key_end:key_end + 2] != b"\0\0":
+                key_end += 2
+            key = data[start + 6:key_end].decode("utf-16-le", "replace")
+            value = (key_end + 5) & ~3
+            blocks.append((key, data[value:min(value + size, block_end)], (
+                (value + size + 3) & ~3, block_end)))
+            start = (start + length + 3) & ~3
+        return blocks
+
+    def icon(self):
+        # Largest image of the first icon group, as a png or ico file
+        groups = self.resources(self.RT_GROUP_ICON)
+        if not groups:
+            return None, None
+        images = dict(self.resources(self.RT_ICON))
+        group = groups[0][1]
+        best = None
+        for index in range(int.from_bytes(group[4:6], "little")):
+            entry = group[6 + index * 14:20 + index * 14]
+            if len(entry) < 14:
+                break
+            ident = int.from_bytes(entry[12:14], "little")
+            size = (entry[0] or 256, int.from_bytes(entry[6:8], "little"))
+            if ident in images and (not best or size > best[0]):
+                best = (size, entry, images[ident])
+        if not best:
+            return None, None
+        _, entry, image = best
+        if image.startswith(b"\x89PNG"):
+            return ".png", image
+        return ".ico", b"".join([
+            b"\0\0\1\0\1\0", entry[:8], len(image).to_bytes(4, "little"),
+            (22).to_bytes(4, "little"), image])
+
+
+# Wine registry file, sections are found with a cached index of the offset
+# of every key, so only the requested keys are read and parsed
+class RegistryHive:
+
+    KEY = re.compile(rb"^\[((?:[^\\\]]|\\.)*)\]")
+    VALUE = re.compile(r'^(@|"((?:[^"\\]|\\.)*)")=(.*)$', re.S)
+
+    def __init__(self, prefix, hive):
+        self.location = os.path.join(prefix, hive)
+        self.hive = hive
+        self.index_file = os.path.join(prefix, "reg-index.json")
+        self.keys = self.read_index()
+
+    def read_index(self):
         try:
-            os.remove(CONFIG_FILE)
-        except OSError:
-            pass
-    return config
+            with open(self.index_file, encoding="utf-8") as f:
+                indexes = json.load(f)
+        except (OSError, ValueError):
+            indexes = {}
+        stat = os.stat(self.location)
+        index = indexes.get(self.hive)
+        if index and [index["mtime"], index["size"]] == [
+                stat.st_mtime_ns, stat.st_size]:
+            return index["keys"]
+        return self.write_index(self.build_index())
 
+    def build_index(self):
+        # Each key spans from its header up to the header of the next key
+        keys = {}
+        offset = 0
+        current = None
+        with open(self.location, "rb") as f:
+            for line in f:
+                match = line.startswith(b"[") and self.KEY.match(line)
+                if match:
+                    name = reg_unescape(match.group(1).decode(
+                        "utf-8", "surrogateescape"))
+                    if current:
+                        current[1] = offset
+                    current = keys[name.lower()] = [offset, None, name]
+                offset += len(line)
+        if current:
+            current[1] = offset
+        return keys
 
-def remove_config(name):
-    config = read_config()
-    config.pop(name, None)
-    if config == {}:
+    def write_index(self, keys):
         try:
-            os.remove(CONFIG_FILE)
+            with open(self.index_file, encoding="utf-8") as f:
+                indexes = json.load(f)
+        except (OSError, ValueError):
+            indexes = {}
+        stat = os.stat(self.location)
+        indexes[self.hive] = {
+            "mtime": stat.st_mtime_ns, "size": stat.st_size, "keys": keys}
+        try:
+            with open(f"{self.index_file}.tmp", "w", encoding="utf-8") as f:
+                json.dump(indexes, f)
+            os.replace(f"{self.index_file}.tmp", self.index_file)
         except OSError:
             pass
-    else:
-        with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-            json.dump(config, f)
+        return keys
 
+    def section(self, key):
+        entry = self.keys.get(key.lower())
+        if not entry:
+            return None
+        with open(self.location, "rb") as f:
+            f.seek(entry[0])
+            return f.read(entry[1] - entry[0]).decode(
+                "utf-8", "surrogateescape")
 
-def modify_config(name, field, value):
-    config = read_config()
-    if name not in config:
-        config[name] = {}
-    config[name][field] = value
-    os.makedirs(CONFIG_FOLDER, exist_ok=True)
-    with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-        json.dump(config, f)
+    def values(self, key):
+        # Values of a key as (name, data), with "@" as the default value
+        section = self.section(key)
+        if section is None:
+            return None
+        values = []
+        for line in reg_lines(section):
+            match = self.VALUE.match(line)
+            if match:
+                name = "@" if match.group(1) == "@" else reg_unescape(
+                    match.group(2))
+                values.append((name, match.group(3)))
+        return values
 
+    def subkeys(self, key):
+        start = f"{key.lower()}\\" if key else ""
+        found = {}
+        for lower, entry in self.keys.items():
+            if lower.startswith(start) and lower != start:
+                sub = entry[2][len(start):].split("\\")[0]
+                found.setdefault(sub.lower(), sub)
+        return sorted(found.values(), key=str.lower)
 
-def list_carafes():
-    carafes = []
-    if os.path.isdir(CONFIG_FOLDER):
-        for item in os.listdir(CONFIG_FOLDER):
-            if os.path.isdir(os.path.join(CONFIG_FOLDER, item)):
-                carafes.append(item)
-    if carafes:
-        print("The following carafes are currently configured:")
-        for carafe in carafes:
-            print(carafe)
-        print(f"Run '{sys.argv[0]} <carafe_name> info' for more information")
-    else:
-        print("There are currently no carafes configured")
-        print(f"Use '{sys.argv[0]} <carafe_name> create' to add a new carafe")
-    sys.exit(0)
+    def set_value(self, key, name, data):
+        if name == "@":
+            line = f"@={data}"
+        else:
+            line = f"\"{reg_escape(name)}\"={data}"
+        with open(self.location, "rb") as f:
+            contents = f.read()
+        entry = self.keys.get(key.lower())
+        if entry:
+            start, end = entry[:2]
+            lines = reg_lines(contents[start:end].decode(
+                "utf-8", "surrogateescape"))
+            for index, existing in enumerate(lines):
+                match = self.VALUE.match(existing)
+                if match and (match.group(1) == "@" if name == "@" else (
+                        match.group(2) is not None and reg_unescape(
+                            match.group(2)).lower() == name.lower())):
+                    lines[index] = line
+                    break
+            else:
+                position = len(lines)
+                while position and not lines[position - 1].strip():
+                    position -= 1
+                lines.insert(position, line)
+        else:
+            # New keys are added at the end, like wine would save them
+            now = int(time.time())
+            start = end = len(contents)
+            lines = [
+                "", f"[{reg_escape(key)}] {now}",
+                f"#time={(now + 11644473600) * 10000000:x}", line]
+        section = "".join(f"{line}\n" for line in lines).encode(
+            "utf-8", "surrogateescape")
+        temp = f"{self.location}.tmp"
+        with open(temp, "wb") as f:
+            f.write(contents[:start] + section + contents[end:])
+        shutil.copymode(self.location, temp)
+        os.replace(temp, self.location)
+        # Keys after the changed one only move, so the index is updated
+        delta = len(section) - (end - start)
+        for other in self.keys.values():
+            if other[0] >= end and other is not entry:
+                other[0] += delta
+                other[1] += delta
+        if entry:
+            entry[1] = start + len(section)
+        else:
+            self.keys[key.lower()] = [start, start + len(section), key]
+        self.write_index(self.keys)
 
+    def export(self, key, root):
+        # Key and all subkeys in the format of 'wine regedit /E'
+        lower = key.lower()
+        output = []
+        for name, entry in sorted(self.keys.items(), key=lambda k: k[1][0]):
+            if name != lower and not name.startswith(f"{lower}\\"):
+                continue
+            output.append(f"\n[{root}\\{entry[2]}]")
+            for value_name, data in self.values(entry[2]):
+                match = re.match(r'^str\((\d+)\):"(.*)"$', data, re.S)
+                if match:
+                    text = reg_unescape(match.group(2)) + "\0"
+                    data = f"hex({match.group(1)}):" + ",".join(
+                        f"{byte:02x}" for byte in text.encode(
+                            "utf-16-le", "surrogatepass"))
+                if value_name == "@":
+                    output.append(f"@={data}")
+                else:
+                    output.append(f"\"{reg_escape(value_name)}\"={data}")
+        return "Windows Registry Editor Version 5.00\n" + "".join(
+            f"{line}\n" for line in output)
 
-def check_for_tool(name, location):
-    if shutil.which(location):
-        return
-    print(f"\nThe required tool '{name}' could not be found")
-    if location == name:
-        print("Please install it using your package manager")
-        print("(Most required tools will be installed with wine)\n")
-        print(f"Or set a custom location in '{CONFIG_FILE}'")
-        print("(You might need to create the file manually)")
-        print(f"(In the main object set '{name}' to the correct path)\n")
-    else:
-        print("The path was manually changed in the config file")
-        print(f"The location is set to '{location}'")
-        print(f"Please remove the custom location from '{CONFIG_FILE}'")
-        print(f"Or update the path to the correct '{name}' location\n")
 
+def launch_frecency(history):
+    # Every launch counts, but its weight halves every two weeks
+    now = time.time()
+    frecency = {}
+    for launch in history:
+        age = max(now - launch.get("time", now), 0) / 86400
+        location = launch.get("location")
+        frecency[location] = frecency.get(location, 0) + 0.5 ** (age / 14)
+    return frecency
+
+
+# Ranked choice of an executable, filtered by each query from the user,
+# with the most used and recently started ones of the carafe on top
+class ExecutablePicker:
+
+    def __init__(self, executables, history):
+        self.executables = executables
+        self.paths = [exe.lower() for exe in executables]
+        self.names = [os.path.basename(path) for path in self.paths]
+        self.trigrams = None
+        self.frecency = launch_frecency(history)
+
+    def candidates(self, word):
+        # Paths with all the trigrams of the word, only built when filtering
+        if len(word) < 3:
+            return set(range(len(self.paths)))
+        if self.trigrams is None:
+            self.trigrams = {}
+            for number, path in enumerate(self.paths):
+                for start in range(len(path) - 2):
+                    self.trigrams.setdefault(
+                        path[start:start + 3], set()).add(number)
+        found = [self.trigrams.get(word[start:start + 3], set())
+                 for start in range(len(word) - 2)]
+        return set.intersection(*sorted(found, key=len))
+
+    def rank(self, query=""):
+        words = query.lower().split()
+        numbers = set(range(len(self.paths)))
+        for word in words:
+            numbers &= self.candidates(word)
+        matches = [n for n in numbers
+                   if all(word in self.paths[n] for word in words)]
+        # Words in the file name rank higher than words in the folders
+        scores = {n: (-sum(word in self.names[n] for word in words), 0)
+                  for n in matches}
+        if words and not matches:
+            # Fuzzy match of the letters of each word in order, such as
+            # "lnchr", ranked by how close together the letters are
+            patterns = [re.compile(".*?".join(
+                re.escape(char) for char in word)) for word in words]
+            for n, path in enumerate(self.paths):
+                found = [pattern.search(path) for pattern in patterns]
+                if all(found):
+                    scores[n] = (0, sum(f.end() - f.start() for f in found))
+            matches = list(scores)
+        return [self.executables[n] for n in sorted(matches, key=lambda n: (
+            scores[n], -self.frecency.get(self.executables[n], 0), n))]
+
+
+# Durations of the different phases of a command, shown with --timings
+class Timings:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.style = None
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    @contextlib.contextmanager
+    def measure(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start)
+
+    def milliseconds(self):
+        phases = {p: round(s * 1000, 3) for p, s in self.phases.items()}
+        phases["total"] = round(
+            (time.perf_counter() - self.started) * 1000, 3)
+        return phases
 
-# Wine command locations, optionally loaded from the config file
+    def report(self, style, command):
+        phases = self.milliseconds()
+        if style == "json":
+            print(json.dumps(
+                {"command": command, "timings_ms": phases}), file=sys.stderr)
+            return
+        print("\nTimings:", file=sys.stderr)
+        for phase, duration in phases.items():
+            print(f"  {phase:<15} {duration:>10.1f} ms", file=sys.stderr)
+
+
+CONFIG = ConfigStore(CONFIG_FILE)
+TIMINGS = Timings()
+DAEMON = None
+# Only the command line replaces itself with wine and exits on errors
+CLI = False
+
+# Wine command locations, optionally overridden in the config file
 # It's recommended to change them manually in the config file and not here
-conf = read_config()
-WINE = conf.get("wine", "wine")
-WINETRICKS = conf.get("winetricks", "winetricks")
-check_for_tool("wine", WINE)
+# Heavier modules are only imported when used, to keep the startup fast
+WINE = "wine"
+WINETRICKS = "winetricks"
+EXCLUDE = ["windows"]
+# Executables that are rarely the program to start, see 'hide_noise'
+NOISE = [
+    "unins*.exe", "uninst*.exe", "vcredist*", "vc_redist*", "dxsetup.exe",
+    "dotnetfx*", "ndp*.exe", "*crashreport*", "*crashhandler*",
+    "*crashpad*", "*errorreporter*"]
+
+
+# Reclaimable data of a carafe per category, as paths relative to the carafe
+# folder, see 'gc_rules' in README
+GC_RULES = {
+    "temp": [
+        "drive_c/users/*/Temp/*", "drive_c/users/*/AppData/Local/Temp/*",
+        "drive_c/users/*/AppData/Local/CrashDumps/*",
+        "drive_c/windows/temp/*"],
+    "logs": ["log.*"],
+    "installers": [
+        "drive_c/ProgramData/Package Cache/*",
+        "drive_c/users/*/AppData/Local/Package Cache/*",
+        "drive_c/users/*/AppData/Local/Downloaded Installations/*",
+        "drive_c/windows/Installer/$PatchCache$/*"],
+    "shaders": [
+        "drive_c/users/*/AppData/Local/D3DSCache/*",
+        "drive_c/users/*/AppData/Local/NVIDIA/DXCache/*",
+        "drive_c/users/*/AppData/Local/NVIDIA/GLCache/*",
+        "drive_c/users/*/AppData/Local/AMD/DxCache/*"]
+}
+
+
+def replace_with_wine(executable, command, env, cwd):
+    # Replace the carafe process with wine, so no python or shell
+    # process is kept around while the program is running
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.chdir(cwd)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    os.execve(executable, command, env)
 
 
 # Carafe class for managing and starting carafes
@@ -112,36 +2196,54 @@ class Carafe:
 
     def __init__(self, name):
         self.name = name
-        self.forbidden_names = ["config.json", "wine", "winetricks"]
+        self.forbidden_names = [
+            "config.json", "config.json.lock", "wine", "winetricks", "exclude",
+            "templates", "log_size", "log_segments", "log_compression",
+            "dedup.json", "daemon.sock", "groups", "noise", "hide_noise",
+            "picker_size", "gc_rules", "versions.json"]
         if not self.name:
-            print("The current name is not allowed because it appears empty")
-            sys.exit(1)
+            raise InvalidName(
+                "The current name is not allowed because it appears empty")
+        # Every name is a folder in ~/.carafe, so it can't point elsewhere
+        if "/" in self.name or self.name in [".", ".."]:
+            raise InvalidName(
+                "The current name is not allowed because it is not a folder")
         if self.name in self.forbidden_names:
-            print("The current name is not allowed because it is reserved")
-            sys.exit(1)
+            raise InvalidName(
+                "The current name is not allowed because it is reserved")
         self.prefix = os.path.join(CONFIG_FOLDER, self.name)
         self.arch = self.read_arch()
         self.link_location = self.read_link()
         self.wine = self.read_wine()
+        self.excluded = self.read_excluded()
 
     # Linked functions directly called from the parser
 
-    def create(self, args):
+    def create(self, arch=None, from_template=False, verbose=False):
         if os.path.isdir(self.prefix):
-            print(
+            raise InvalidName(
                 f"{self.name} is already a carafe\n"
                 f"Please see the list with '{sys.argv[0]} list'")
-            sys.exit(1)
-        os.makedirs(self.prefix, exist_ok=True)
-        self.arch = args.arch
-        remove_config(self.name)
+        self.arch = arch
+        CONFIG.remove(self.name)
         if self.arch:
-            modify_config(self.name, "arch", self.arch)
-        self.run_command(f"{self.wine} wineboot --init", args.verbose)
+            CONFIG.modify(self.name, "arch", self.arch)
+        check_for_tool("wine", self.wine)
+        if from_template:
+            template = template_location(self.wine, self.arch)
+            if os.path.isdir(template):
+                PrefixCopier(template, self.prefix).run(progress=False)
+                self.update_index()
+                return
+            print("No template found for the current wine version and arch")
+            print("Creating the carafe with wineboot instead, this may take "
+                  f"a while (see '{sys.argv[0]} template build')")
+        os.makedirs(self.prefix, exist_ok=True)
+        self.run_command(f"{self.wine} wineboot --init", verbose)
+        self.update_index()
 
-    def install(self, args):
+    def install(self, executable=None, verbose=False):
         self.exists()
-        executable = args.executable
         if not executable:
             executable = input(
                 "To install a program to the carafe, enter the location: ")
@@ -152,87 +2254,173 @@ class Carafe:
                 executable = executable[::-1].replace(char, "", 1)[::-1]
         executable = executable.strip()
         if not os.path.isfile(executable):
-            print("The specified executable could not be found")
-            sys.exit(1)
+            raise LocationNotFound(
+                "The specified executable could not be found")
+        check_for_tool("wine", self.wine)
         if executable.endswith(".msi"):
             self.run_command(
-                f"{self.wine} msiexec /i \"{executable}\"", args.verbose)
+                f"{self.wine} msiexec /i \"{executable}\"", verbose)
         else:
-            self.run_command(f"{self.wine} \"{executable}\"", args.verbose)
+            self.run_command(f"{self.wine} \"{executable}\"", verbose)
+        self.update_index()
 
-    def start(self, args):
+    def start(self, location=None, arguments=(), env=None, ask=False,
+              hide_noise=False, keep_log=False, verbose=False, wait=False,
+              warm=False, preload=False):
         self.exists()
-        if args.ask:
-            start = self.ask_for_executable(True)
+        if ask:
+            start = self.ask_for_executable(True, hide_noise)
             if start == "link":
                 start = self.link_location
-        elif args.location:
-            start = self.try_to_sanitize_location(args.location)
-        elif not self.link_location:
-            print(
-                f"{self.name} has no default/linked program path\n"
-                f"Please add one with '{sys.argv[0]} {self.name} link'")
-            sys.exit(1)
+        elif location:
+            start = self.try_to_sanitize_location(location)
         else:
-            start = self.link_location
+            start = self.require_link()
         self.arch = self.read_arch()
+        check_for_tool("wine", self.wine)
+        if warm and not self.server_running():
+            self.start_server(600, False)
+        if preload:
+            with TIMINGS.measure("preload"):
+                preload_files(self.preload_locations(start))
         path = os.path.join(self.prefix, "drive_c", start)
-        arg_string = " ".join(args.arguments)
-        if args.keep_log or args.verbose:
+        if keep_log or verbose:
+            arg_string = " ".join(shlex.quote(a) for a in arguments)
             self.run_command(
-                f"{self.wine} \"{path}\" {arg_string}",
-                args.verbose, cwd=os.path.dirname(path))
+                f"{self.wine} {shlex.quote(path)} {arg_string}",
+                verbose, cwd=os.path.dirname(path), env=env)
+            self.record_launch(start)
+            return None
+        environment = self.environment()
+        environment["WINEDEBUG"] = "-all"
+        environment.update(env or {})
+        command = shlex.split(self.wine) + [path] + list(arguments)
+        if wait:
+            spawned = time.perf_counter()
+            proc = subprocess.Popen(
+                command, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                cwd=os.path.dirname(path), env=environment)
+            TIMINGS.add("process spawn", time.perf_counter() - spawned)
+            proc.wait()
+            TIMINGS.add("exit", time.perf_counter() - spawned)
+            self.record_launch(start)
+            return proc
+        return self.exec_wine(
+            command, environment, os.path.dirname(path), start)
+
+    def preload(self, location=None, record=False):
+        self.exists()
+        if location:
+            start = self.try_to_sanitize_location(location)
         else:
-            env = os.environ
-            env["WINEPREFIX"] = self.prefix
-            if self.arch:
-                env["WINEARCH"] = self.arch
-            env["WINEDEBUG"] = "-all"
-            subprocess.run(
-                f"{self.wine} \"{path}\" {arg_string}", shell=True,
-                stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
-                cwd=os.path.dirname(path), env=env)
+            start = self.require_link()
+        if record:
+            return self.record_preload(start)
+        locations = self.preload_locations(start)
+        size = preload_files(locations)
+        print(f"Preloaded {len(locations)} files of {start}, "
+              f"{size / 1024 ** 2:.1f} MB")
+        return locations
 
-    def rename(self, args):
-        self.copy(args)
-        self.remove(None)
+    def rename(self, newname):
+        self.exists()
+        newname, newpath = self.check_new_name(newname)
+        os.rename(self.prefix, newpath)
+        CONFIG.rename(self.name, newname)
 
-    def copy(self, args):
+    def copy(self, newname, mode="reflink"):
         self.exists()
-        newname = args.newname.replace(" ", "").replace("/", "-")
-        if not newname:
-            print("The new name is not allowed because it appears empty")
-            sys.exit(1)
-        additional_reserved = ["-h", "--help", "list"]
-        if newname in self.forbidden_names or newname in additional_reserved:
-            print("The new name is not allowed because it is reserved")
-            sys.exit(1)
-        newpath = os.path.join(CONFIG_FOLDER, newname)
-        if os.path.isdir(newpath):
-            print(
-                f"{newname} is already a carafe\n"
-                f"Please see the list with '{sys.argv[0]} list'")
-            sys.exit(1)
-        shutil.copytree(self.prefix, newpath, symlinks=True)
-        if self.arch:
-            modify_config(newname, "arch", self.arch)
-        if self.link_location:
-            modify_config(newname, "link", self.link_location)
-        try:
-            os.remove(os.path.join(newpath, "log"))
-        except OSError:
-            pass
+        newname, newpath = self.check_new_name(newname)
+        PrefixCopier(
+            self.prefix, newpath, mode, skip=["log", "log.*"]).run()
+        for field, value in CONFIG.carafe(self.name).items():
+            CONFIG.modify(newname, field, value)
+        Carafe(newname).update_index()
 
-    def remove(self, _args):
-        remove_config(self.name)
+    def remove(self):
+        CONFIG.remove(self.name)
         self.exists()
         shutil.rmtree(self.prefix)
-        if not os.listdir(CONFIG_FOLDER):
+        CONFIG.save()
+        leftovers = set(os.listdir(CONFIG_FOLDER))
+        if not leftovers - {os.path.basename(CONFIG.lock_location)}:
             shutil.rmtree(CONFIG_FOLDER)
 
-    def info(self, _args):
+    def export(self, file, incremental=None):
+        self.exists()
+        if self.server_running():
+            raise CarafeRunning(
+                f"{self.name} is still running, stop it first with "
+                f"'{sys.argv[0]} {self.name} stop'")
+        base = {}
+        if incremental:
+            base = read_export_manifest(incremental)
+        entries = prefix_entries(self.prefix)
+        files = {path for path, kind, _ in entries if kind == "file"}
+        meta = {
+            "name": self.name,
+            "version": __version__,
+            "config": CONFIG.carafe(self.name),
+            "incremental": bool(incremental),
+            "deleted": sorted(set(base) - files)
+        }
+        import tarfile
+        output = sys.stdout.buffer
+        if file != "-":
+            output = open(f"{file}.tmp", "wb")
+        manifest = {}
+        stored = 0
+        with output:
+            stream = ParallelGzip(output)
+            with tarfile.open(fileobj=stream, mode="w",
+                              format=tarfile.PAX_FORMAT) as tar:
+                add_json_member(tar, "carafe.json", meta)
+                for path, kind, stat in [("", "folder", os.stat(
+                        self.prefix))] + entries:
+                    location = os.path.join(self.prefix, path)
+                    info = tarfile.TarInfo(f"prefix/{path}".rstrip("/"))
+                    info.mode = stat.st_mode & 0o7777
+                    info.mtime = stat.st_mtime
+                    if kind == "folder":
+                        info.type = tarfile.DIRTYPE
+                        tar.addfile(info)
+                        continue
+                    if kind == "link":
+                        info.type = tarfile.SYMTYPE
+                        info.linkname = os.readlink(location)
+                        tar.addfile(info)
+                        continue
+                    # Unchanged files are only listed in the manifest
+                    old = base.get(path)
+                    current = [stat.st_size, stat.st_mtime_ns]
+                    if old and old[:2] == current:
+                        manifest[path] = old
+                        continue
+                    if old and old[0] == stat.st_size:
+                        digest = hash_file(location)
+                        if digest == old[2]:
+                            manifest[path] = current + [digest]
+                            continue
+                    info.size = stat.st_size
+                    with open(location, "rb") as f:
+                        reader = HashingReader(f)
+                        tar.addfile(info, reader)
+                    manifest[path] = current + [reader.digest.hexdigest()]
+                    stored += 1
+                # The manifest is last, in its own gzip member
+                stream.flush()
+                offset = stream.offset
+                add_json_member(tar, "manifest.json", manifest)
+            stream.close()
+            output.write(export_trailer(offset))
+        if file != "-":
+            os.replace(f"{file}.tmp", file)
+            print(f"Exported {stored} of {len(files)} file(s) and "
+                  f"{len(meta['deleted'])} deletion(s) to '{file}'")
+        return manifest
+
+    def info(self, hide_noise=False):
         self.exists()
-        executables = self.list_executables()
         print(f"All information about carafe '{self.name}':")
         if self.arch:
             print(f"Configured with custom arch: {self.arch}")
@@ -247,10 +2435,14 @@ class Carafe:
             "When a carafe is linked, you can start the program with "
             f"'{sys.argv[0]} {self.name} start'")
         print(f"To modify the link, use '{sys.argv[0]} {self.name} link'")
-        if executables:
-            print("\nThe current list of executables looks like this:")
-            for exe in executables:
-                print(f"C:/{exe}")
+        found = False
+        for exe, pe_details in self.executable_details(
+                self.listed_executables(hide_noise)):
+            if not found:
+                print("\nThe current list of executables looks like this:")
+                found = True
+            print(f"C:/{exe}  {executable_tags(pe_details)}".rstrip())
+        if found:
             print(
                 f"You can add more with '{sys.argv[0]} {self.name} install'")
         else:
@@ -258,27 +2450,37 @@ class Carafe:
             print(
                 f"Please add them with '{sys.argv[0]} {self.name} install'")
 
-    def link(self, args):
+    def details(self, hide_noise=False):
+        self.exists()
+        executables = self.executable_details(
+            self.listed_executables(hide_noise))
+        return {
+            "name": self.name, "prefix": self.prefix, "arch": self.arch,
+            "wine": self.wine, "link": self.link_location,
+            "executables": dict(executables)
+        }
+
+    def link(self, location=None, hide_noise=False):
         self.exists()
-        if args.location:
-            loc = self.try_to_sanitize_location(args.location)
+        if location:
+            loc = self.try_to_sanitize_location(location)
         else:
-            loc = self.ask_for_executable(False)
-        modify_config(self.name, "link", loc)
+            loc = self.ask_for_executable(False, hide_noise)
+        CONFIG.modify(self.name, "link", loc)
+        self.link_location = loc
+        return loc
 
-    def shortcut(self, args):
+    def shortcut(self, output_folder, location=None, name=None,
+                 shortcut_type=None, hide_noise=False):
         self.exists()
-        if not os.path.isdir(args.output_folder):
-            print("The output folder does not seem to exist")
-            sys.exit(1)
-        loc = args.location
+        if not os.path.isdir(output_folder):
+            raise LocationNotFound("The output folder does not seem to exist")
+        loc = location
         if not loc:
-            loc = self.ask_for_executable(True)
+            loc = self.ask_for_executable(True, hide_noise)
         elif loc != "link":
-            loc = self.try_to_sanitize_location(args.location)
-        if args.type:
-            shortcut_type = args.type
-        else:
+            loc = self.try_to_sanitize_location(location)
+        if not shortcut_type:
             shortcut_type = ""
             print("carafe can make two types of shortcut")
             print("One type needs carafe, but it can auto-update the link")
@@ -289,99 +2491,511 @@ class Carafe:
             shortcut_contents = self.carafe_shortcut(loc)
         else:
             shortcut_contents = self.wine_shortcut(loc)
-        if args.name:
-            file_name = f"{args.name}.desktop"
+        if name:
+            file_name = f"{name}.desktop"
         else:
             file_name = f"{self.name}.desktop"
-        output_file = os.path.join(args.output_folder, file_name)
+        output_file = os.path.join(output_folder, file_name)
         with open(output_file, "w", encoding="utf-8") as f:
             f.write(shortcut_contents)
+        return output_file
 
-    def log(self, _args):
+    def log(self, tail=None, follow=False, grep=None, channel=None,
+            summary=False, all_sessions=False, program=None):
         self.exists()
         log_file = os.path.join(self.prefix, "log")
-        if os.path.isfile(log_file):
-            with open(log_file, encoding="utf-8") as f:
-                print(f.read())
-        else:
+        if program:
+            log_file = os.path.join(self.prefix, program_log(program))
+        if not os.path.isfile(log_file) and program:
+            print(f"No logs for '{program}' in '{self.name}' carafe yet")
+            return
+        if not os.path.isfile(log_file):
             print(f"No logs for '{self.name}' carafe yet")
+            return
+        matches = log_filter(grep, channel)
+        output = sys.stdout.buffer
+        segments = log_segments(log_file)
+        with open(log_file, "rb", buffering=1024 * 1024) as f:
+            if not all_sessions:
+                segments = session_segments(segments, f)
+            if summary:
+                counts = Counter()
+                for line in log_lines(segments, f):
+                    found = LOG_CHANNEL.match(line)
+                    if found and matches(line):
+                        counts[b":".join(found.groups()).decode()] += 1
+                for channel, count in counts.most_common():
+                    print(f"{count:>10} {channel}")
+                return
+            if tail is not None:
+                lines = list(tail_lines(f, tail, matches))
+                if len(lines) < tail and segments:
+                    # Not enough in the active log, so read the older parts
+                    f.seek(0)
+                    lines = deque((line for line in log_lines(
+                        segments, f) if matches(line)), maxlen=tail)
+                output.writelines(lines)
+            else:
+                output.writelines(
+                    line for line in log_lines(segments, f) if matches(line))
+            output.flush()
+            if follow:
+                f.seek(0, os.SEEK_END)
+                self.follow_log(f, log_file, matches)
+
+    def follow_log(self, f, log_file, matches):
+        partial = b""
+        try:
+            while True:
+                data = f.read()
+                if data:
+                    lines = (partial + data).split(b"\n")
+                    partial = lines.pop()
+                    sys.stdout.buffer.writelines(
+                        line + b"\n" for line in lines if matches(line))
+                    sys.stdout.flush()
+                    continue
+                try:
+                    rotated = os.stat(log_file).st_ino != os.fstat(
+                        f.fileno()).st_ino
+                except OSError:
+                    rotated = False
+                # A new session or rotation without parts empties the log
+                if os.fstat(f.fileno()).st_size < f.tell():
+                    f.seek(0)
+                    partial = b""
+                    continue
+                if rotated:
+                    f.close()
+                    f = open(log_file, "rb")
+                    partial = b""
+                    continue
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            print()
+        finally:
+            f.close()
+
+    def regedit(self, verbose=False):
+        self.exists()
+        check_for_tool("wine", self.wine)
+        self.run_command(f"{self.wine} regedit", verbose)
+
+    def reg(self, action, key, name=None, data=None, value_type="string",
+            all_carafes=False):
+        if action in ["get", "set"] and not name:
+            raise CarafeError(
+                f"The name of the value is required for 'reg {action}'")
+        if action == "set" and data is None:
+            raise CarafeError(
+                "The data of the value is required for 'reg set'")
+        if not all_carafes:
+            self.exists()
+            return self.registry(action, key, name, data, value_type, "")
+        failed = None
+        for carafe in carafe_names():
+            try:
+                Carafe(carafe).registry(
+                    action, key, name, data, value_type, f"{carafe}: ")
+            except CarafeError as e:
+                print(e)
+                failed = e
+        if failed:
+            raise CarafeError(
+                "The registry could not be read or changed for all carafes")
+        return None
+
+    def registry(self, action, key, name, data, value_type, label):
+        path = key
+        hive, key, root = parse_reg_key(path)
+        if not os.path.isfile(os.path.join(self.prefix, hive)):
+            raise LocationNotFound(
+                f"{label}The registry file '{hive}' does not exist yet")
+        registry = RegistryHive(self.prefix, hive)
+        if action == "set":
+            # The wineserver keeps the registry in memory and overwrites it
+            if self.server_running():
+                raise CarafeRunning(
+                    f"{label}{self.name} is running, stop it first with "
+                    f"'{sys.argv[0]} {self.name} stop'")
+            if value_type == "dword":
+                try:
+                    number = int(data, 0)
+                except ValueError as e:
+                    raise CarafeError(
+                        f"{label}The data should be a number for a dword"
+                    ) from e
+                if not 0 <= number <= 0xFFFFFFFF:
+                    raise CarafeError(
+                        f"{label}A dword should be between 0 and 0xFFFFFFFF")
+                data = f"dword:{number:08x}"
+            elif value_type == "expand":
+                data = f"str(2):\"{reg_escape(data)}\""
+            else:
+                data = f"\"{reg_escape(data)}\""
+            registry.set_value(key, name, data)
+            return data
+        values = registry.values(key)
+        subkeys = registry.subkeys(key)
+        if values is None and not subkeys:
+            raise LocationNotFound(f"{label}The key '{path}' does not exist")
+        if action == "get":
+            for value, data in values or []:
+                if value.lower() == name.lower():
+                    print(f"{label}{reg_data(data)}")
+                    return reg_data(data)
+            raise LocationNotFound(
+                f"{label}The value '{name}' does not exist")
+        if action == "list":
+            for sub in subkeys:
+                print(f"{label}{sub}\\")
+            for value, data in values or []:
+                print(f"{label}{value}={data}")
+            return {"subkeys": subkeys, "values": values or []}
+        exported = registry.export(key, root)
+        print(exported, end="")
+        return exported
+
+    def winecfg(self, verbose=False):
+        self.exists()
+        check_for_tool("wine", self.wine)
+        self.run_command(f"{self.wine} winecfg", verbose)
 
-    def regedit(self, args):
+    def winetricks(self, arguments=(), verbose=False):
         self.exists()
-        self.run_command(f"{self.wine} regedit", args.verbose)
+        winetricks = CONFIG.get("winetricks", WINETRICKS)
+        check_for_tool("wine", self.wine)
+        check_for_tool("winetricks", winetricks)
+        arg_string = " ".join(arguments)
+        self.run_command(f"{winetricks} {arg_string}", verbose)
+        self.update_index()
 
-    def winecfg(self, args):
+    def stats(self):
         self.exists()
-        self.run_command(f"{self.wine} winecfg", args.verbose)
+        launches = self.read_history()
+        if not launches:
+            print(f"No launches of '{self.name}' were recorded yet")
+            return
+        last = time.strftime(
+            "%Y-%m-%d %H:%M", time.localtime(launches[-1]["time"]))
+        print(f"Launch timings of '{self.name}' in ms "
+              f"({len(launches)} launches, last on {last}):")
+        print(f"{'PHASE':<16} {'P50':>9} {'P90':>9} {'P99':>9} {'MAX':>9}")
+        phases = []
+        for launch in launches:
+            for phase in launch["timings"]:
+                if phase not in phases:
+                    phases.append(phase)
+        for phase in phases:
+            values = sorted(
+                launch["timings"][phase] for launch in launches
+                if phase in launch["timings"])
+            print(f"{phase:<16} {percentile(values, 50):>9.1f} "
+                  f"{percentile(values, 90):>9.1f} "
+                  f"{percentile(values, 99):>9.1f} {values[-1]:>9.1f}")
+        print("\nLaunches and median total time per wine version:")
+        versions = {}
+        for launch in launches:
+            versions.setdefault(launch.get("wine") or "unknown", []).append(
+                launch["timings"].get("total", 0))
+        for version, totals in versions.items():
+            print(f"{version}: {len(totals)} launches, "
+                  f"{percentile(sorted(totals), 50):.1f} ms")
+
+    def warm(self, idle_timeout=0, services=False):
+        self.exists()
+        check_for_tool("wine", self.wine)
+        self.start_server(idle_timeout, services)
+        if idle_timeout:
+            print(f"The wineserver of '{self.name}' will keep running until "
+                  f"{idle_timeout} seconds after the last program exits")
+        else:
+            print(f"The wineserver of '{self.name}' will keep running until "
+                  f"stopped with '{sys.argv[0]} {self.name} stop'")
 
-    def winetricks(self, args):
+    def gc(self, yes=False):
         self.exists()
-        check_for_tool("winetricks", WINETRICKS)
-        arg_string = " ".join(args.arguments)
-        self.run_command(f"{WINETRICKS} {arg_string}", args.verbose)
+        return collect_garbage([self.name], yes)
+
+    def stop(self):
+        self.exists()
+        wineserver = wineserver_for(self.wine)
+        for flag in ["-k", "-w"]:
+            subprocess.run(
+                f"{wineserver} {flag}", shell=True, env=self.environment(),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
     # Class helper functions
 
     def exists(self):
         if not os.path.isdir(self.prefix):
-            print(
+            raise UnknownCarafe(
                 f"{self.name} is not a known carafe\n"
                 f"For a list of all carafes: '{sys.argv[0]} list'\n"
                 f"Or add a new one with '{sys.argv[0]} {self.name} create'")
-            sys.exit(1)
+
+    def check_new_name(self, newname):
+        newname = sanitize_name(newname)
+        if not newname:
+            raise InvalidName(
+                "The new name is not allowed because it appears empty")
+        additional_reserved = [
+            "-h", "--help", "list", "find", "template", "apply", "dedup",
+            "import", "daemon", "run-group", "shortcut-sync", "gc"]
+        if newname in self.forbidden_names or newname in additional_reserved:
+            raise InvalidName(
+                "The new name is not allowed because it is reserved")
+        if newname in [".", ".."]:
+            raise InvalidName(
+                "The new name is not allowed because it is not a folder")
+        newpath = os.path.join(CONFIG_FOLDER, newname)
+        if os.path.isdir(newpath):
+            raise InvalidName(
+                f"{newname} is already a carafe\n"
+                f"Please see the list with '{sys.argv[0]} list'")
+        return newname, newpath
 
     def read_link(self):
-        config = read_config()
-        if self.name in config:
-            if "link" in config[self.name]:
-                return config[self.name]["link"]
-        return None
+        return CONFIG.carafe(self.name).get("link")
 
     def read_wine(self):
-        config = read_config()
-        if self.name in config:
-            if "wine" in config[self.name]:
-                return config[self.name]["wine"]
-        return WINE
+        return self.read_setting("wine", WINE)
+
+    def read_excluded(self):
+        return self.read_setting("exclude", EXCLUDE)
+
+    def read_setting(self, field, default):
+        return CONFIG.carafe(self.name).get(field, CONFIG.get(field, default))
 
     def read_arch(self):
-        config = read_config()
-        if self.name in config:
-            if "arch" in config[self.name]:
-                return config[self.name]["arch"]
-        return None
+        return CONFIG.carafe(self.name).get("arch")
 
-    def run_command(self, command, verbose, cwd=None):
-        env = os.environ
-        env["WINEPREFIX"] = self.prefix
-        if self.arch:
-            env["WINEARCH"] = self.arch
-        log_file = os.path.join(self.prefix, "log")
-        if verbose:
-            with open(log_file, "w", encoding="utf-8") as output:
-                proc = subprocess.Popen(
-                    command, shell=True, stderr=subprocess.STDOUT, text=True,
-                    stdout=subprocess.PIPE, bufsize=1, cwd=cwd, env=env)
-                try:
-                    for line in proc.stdout:
-                        sys.stdout.write(line)
-                        sys.stdout.flush()
-                        output.write(line)
-                        output.flush()
-                finally:
-                    rest = proc.stdout.read()
-                    if rest:
-                        sys.stdout.write(rest)
-                        sys.stdout.flush()
-                        output.write(rest)
-                        output.flush()
-                    proc.stdout.close()
-                    proc.wait()
-            return
-        with open(log_file, "wb") as output:
+    def environment(self):
+        with TIMINGS.measure("env setup"):
+            env = dict(os.environ)
+            env["WINEPREFIX"] = self.prefix
+            if self.arch:
+                env["WINEARCH"] = self.arch
+        return env
+
+    def exec_wine(self, command, env, cwd, location):
+        executable = shutil.which(command[0], path=env.get("PATH"))
+        if not executable:
+            raise ToolNotFound(
+                f"The wine executable '{command[0]}' could not be found")
+        self.record_launch(location)
+        if DAEMON:
+            # The command that asked the daemon starts wine by itself
+            DAEMON.launch = {
+                "executable": executable, "command": command, "env": env,
+                "cwd": cwd}
+            return None
+        if not CLI:
+            # When used as a library, wine is started as a child process
+            return subprocess.Popen(
+                command, executable=executable, env=env, cwd=cwd,
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+        CONFIG.save()
+        if TIMINGS.style:
+            TIMINGS.report(TIMINGS.style, "start")
+        replace_with_wine(executable, command, env, cwd)
+
+    def record_launch(self, location):
+        history_file = os.path.join(self.prefix, "history.jsonl")
+        timings = TIMINGS.milliseconds()
+        launch = {
+            "time": int(time.time()), "location": location,
+            "wine": wine_version(self.wine), "timings": timings
+        }
+        try:
+            with open(history_file, "a", encoding="utf-8") as f:
+                f.write(f"{json.dumps(launch)}\n")
+            # Only the most recent launches are kept to keep the file small
+            if os.path.getsize(history_file) > 256 * 1024:
+                launches = self.read_history()[-500:]
+                with open(f"{history_file}.tmp", "w", encoding="utf-8") as f:
+                    f.writelines(f"{json.dumps(item)}\n" for item in launches)
+                os.replace(f"{history_file}.tmp", history_file)
+        except OSError:
+            pass
+
+    def read_history(self):
+        launches = []
+        try:
+            with open(os.path.join(self.prefix, "history.jsonl"),
+                      encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        launches.append(json.loads(line))
+                    except ValueError:
+                        pass
+        except OSError:
+            pass
+        return launches
+
+    def read_preload(self):
+        try:
+            with open(os.path.join(self.prefix, "preload.json"),
+                      encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def preload_locations(self, start):
+        # Files recorded during a previous launch, otherwise the program,
+        # the dlls next to it and all the dlls it imports, recursively
+        recorded = self.read_preload().get(start)
+        if recorded:
+            return [os.path.join(self.prefix, f) for f in recorded]
+        exe = os.path.join(self.prefix, "drive_c", start)
+        folder = os.path.dirname(exe)
+        try:
+            locations = [exe] + [
+                os.path.join(folder, f) for f in os.listdir(folder)
+                if f.lower().endswith(".dll")]
+            with PEFile(exe) as pe:
+                machine = pe.machine
+        except (OSError, ValueError):
+            return [exe]
+        system = "system32"
+        if machine == 0x14C and self.read_arch() != "win32":
+            system = "syswow64"
+        folders = [folder, os.path.join(
+            self.prefix, "drive_c", "windows", system)]
+        folders += wine_dll_folders(self.wine, machine)
+        contents = {}
+        for search in folders:
+            try:
+                contents[search] = {f.lower(): f for f in os.listdir(search)}
+            except OSError:
+                contents[search] = {}
+        queue = [exe]
+        seen = set()
+        while queue:
+            try:
+                with PEFile(queue.pop()) as pe:
+                    imports = pe.imports()
+            except (OSError, ValueError):
+                continue
+            for name in set(imports) - seen:
+                seen.add(name)
+                found = [os.path.join(search, contents[search][name])
+                         for search in folders if name in contents[search]]
+                locations += found
+                queue += found[-1:]
+        return list(dict.fromkeys(locations))
+
+    def record_preload(self, start):
+        # Sample the files used by the wine processes of this carafe until
+        # they all exit, so exactly those can be preloaded next time
+        if not os.path.isdir("/proc"):
+            raise CarafeError(
+                "Recording requires the /proc filesystem of Linux")
+        print(f"Waiting for the wine processes of '{self.name}', start "
+              f"{start} now in another terminal, or press ctrl-c to stop")
+        files = set()
+        marker = f"WINEPREFIX={self.prefix}\0".encode()
+        try:
+            while True:
+                pids = []
+                for pid in os.listdir("/proc"):
+                    if not pid.isdigit() or int(pid) == os.getpid():
+                        continue
+                    try:
+                        with open(f"/proc/{pid}/environ", "rb") as f:
+                            if marker in f.read():
+                                pids.append(pid)
+                    except OSError:
+                        pass
+                if not pids and files:
+                    break
+                for pid in pids:
+                    files |= process_files(pid)
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        recorded = sorted({
+            os.path.relpath(f, self.prefix)
+            if f.startswith(f"{self.prefix}/") else f for f in files})
+        preload = self.read_preload()
+        preload[start] = recorded
+        location = os.path.join(self.prefix, "preload.json")
+        with open(f"{location}.tmp", "w", encoding="utf-8") as f:
+            json.dump(preload, f, indent=2)
+        os.replace(f"{location}.tmp", location)
+        print(f"Recorded {len(recorded)} files to preload for {start}")
+        return recorded
+
+    def server_running(self):
+        # Wine keeps the server files in a folder named after the prefix inode
+        if not fcntl:
+            return False
+        try:
+            stat = os.stat(self.prefix)
+        except OSError:
+            return False
+        lock_file = os.path.join(
+            "/tmp", f".wine-{os.getuid()}",
+            f"server-{stat.st_dev:x}-{stat.st_ino:x}", "lock")
+        try:
+            with open(lock_file, "r+b") as lock:
+                fcntl.lockf(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+        except OSError as e:
+            return not isinstance(e, FileNotFoundError)
+        return False
+
+    def start_server(self, idle_timeout, services):
+        # The wineserver detaches itself once it's ready for programs
+        env = self.environment()
+        persistent = f"-p{idle_timeout}" if idle_timeout else "-p"
+        subprocess.run(
+            f"{wineserver_for(self.wine)} {persistent}", shell=True, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if services:
+            env["WINEDEBUG"] = "-all"
             subprocess.run(
-                command, shell=True, stderr=output, stdout=output,
-                cwd=cwd, env=env)
+                f"{self.wine} wineboot", shell=True, env=env,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def run_command(self, command, verbose, cwd=None, env=None):
+        output = self.open_log(command)
+        environment = self.environment()
+        environment.update(env or {})
+        spawned = time.perf_counter()
+        proc = subprocess.Popen(
+            command, shell=True, stderr=subprocess.STDOUT,
+            stdout=subprocess.PIPE, cwd=cwd, env=environment)
+        TIMINGS.add("process spawn", time.perf_counter() - spawned)
+        first_output = True
+        try:
+            while True:
+                data = proc.stdout.read1(65536)
+                if first_output:
+                    TIMINGS.add("first output", time.perf_counter() - spawned)
+                    first_output = False
+                if not data:
+                    break
+                if verbose:
+                    sys.stdout.buffer.write(data)
+                    sys.stdout.flush()
+                output.write(data)
+        finally:
+            proc.stdout.close()
+            proc.wait()
+            TIMINGS.add("exit", time.perf_counter() - spawned)
+            output.close()
+
+    def open_log(self, title, name="log"):
+        compression = self.read_setting("log_compression", "gzip")
+        if compression not in LogWriter.EXTENSIONS:
+            compression = None
+        return LogWriter(
+            os.path.join(self.prefix, name),
+            max_size=int(self.read_setting("log_size", 64) * 1024 ** 2),
+            segments=int(self.read_setting("log_segments", 4)),
+            compression=compression, title=title)
 
     def try_to_sanitize_location(self, loc):
         loc = loc.strip()
@@ -394,65 +3008,268 @@ class Carafe:
         loc = loc.strip()
         absolute = os.path.join(self.prefix, "drive_c", loc)
         if not os.path.isfile(absolute):
-            print("Location provided could not be found")
-            sys.exit(1)
+            raise LocationNotFound("Location provided could not be found")
         return loc
 
+    def require_link(self):
+        if not self.link_location:
+            raise LocationNotFound(
+                f"{self.name} has no default/linked program path\n"
+                f"Please add one with '{sys.argv[0]} {self.name} link'")
+        return self.link_location
+
     def list_executables(self):
         drive_c = os.path.join(self.prefix, "drive_c")
-        windows = os.path.join(drive_c, "windows")
-        exe_pattern = os.path.join(drive_c, "**", "*.exe")
+        cached = read_index(self.prefix)
+        index = {}
+        executables = []
+        scan = scan_executables(
+            drive_c, self.excluded, cached.get("folders", {}), index)
+        while True:
+            with TIMINGS.measure("prefix scan"):
+                exe = next(scan, None)
+            if exe is None:
+                break
+            executables.append(exe)
+            yield exe
+        if index != cached.get("folders") or \
+                executables != cached.get("executables"):
+            write_index(self.prefix, {
+                "executables": executables, "folders": index})
+
+    def update_index(self):
+        for _ in self.list_executables():
+            pass
+
+    def listed_executables(self, hide_noise=False):
+        hide_noise = hide_noise or self.read_setting("hide_noise", False)
+        for exe in self.list_executables():
+            if not hide_noise or not self.is_noise(exe):
+                yield exe
+
+    def ask_for_executable(self, include_link, hide_noise=False):
+        hide_noise = hide_noise or self.read_setting("hide_noise", False)
+        size = max(int(self.read_setting("picker_size", 20)), 1)
+        history = self.read_history()
+        frecency = launch_frecency(history)
+        scan = self.listed_executables(hide_noise)
         executables = []
-        exe_files = sorted(glob.glob(exe_pattern, recursive=True))
-        for exe in exe_files:
-            if not exe.startswith(windows):
-                exe = exe.replace(drive_c, "", 1)
-                if exe.startswith("/"):
-                    exe = exe.replace("/", "", 1)
+
+        def first_page():
+            # The most used ones are known before the scan, the rest of the
+            # page is shown in the order the scan finds them
+            page = [loc for loc in sorted(
+                frecency, key=frecency.get, reverse=True)
+                if isinstance(loc, str) and os.path.isfile(
+                    os.path.join(self.prefix, "drive_c", loc))
+                and not (hide_noise and self.is_noise(loc))][:size]
+            yield from page
+            if len(page) >= size:
+                return
+            for exe in scan:
                 executables.append(exe)
-        return executables
+                if exe not in page:
+                    page.append(exe)
+                    yield exe
+                if len(page) >= size:
+                    return
 
-    def ask_for_executable(self, include_link):
-        executables = self.list_executables()
-        if not executables:
-            print(
-                "There are currently no executables found for this carafe")
-            print(
+        shown = self.print_choices(first_page())
+        executables.extend(scan)
+        if not shown:
+            raise LocationNotFound(
+                "There are currently no executables found for this carafe\n"
                 f"Please add them with '{sys.argv[0]} {self.name} install'")
-            sys.exit(1)
-        for index, exe in enumerate(executables):
-            print(f"{index}: C:/{exe}")
+        executables += [exe for exe in shown if exe not in executables]
+        picker = ExecutablePicker(executables, history)
+        total = len(executables)
         link_text = ""
         if self.link_location and include_link:
-            print(f"link: C:/{self.link_location}")
             link_text = " (or choose 'link')"
-        chosen_app = -1
-        while chosen_app < 0 or chosen_app >= len(executables):
-            chosen_app = input(
+        query = ""
+        while True:
+            if not shown:
+                print(f"No executables match '{query}'")
+            if total > len(shown):
+                print(f"Showing {len(shown)} of {total}, type part of "
+                      "the name or path to filter (start with / to "
+                      "search for a number)")
+            if link_text:
+                print(f"link: C:/{self.link_location}")
+            answer = input(
                 "Choose the number of the application "
-                f"location{link_text}: ").strip()
-            if chosen_app == "link" and link_text:
-                break
+                f"location{link_text}, or type to filter: ").strip()
+            # A leading "/" always filters, to search for names like "2k"
+            if answer.startswith("/"):
+                answer = answer[1:].strip()
+            elif answer == "link" and link_text:
+                return "link"
+            elif answer.isdigit() and int(answer) < len(shown):
+                return shown[int(answer)]
+            query = answer
+            ranked = picker.rank(query)
+            shown = self.print_choices(ranked[:size])
+            total = len(ranked)
+
+    def print_choices(self, executables):
+        shown = []
+        for index, (exe, details) in enumerate(
+                self.executable_details(executables)):
+            print(f"{index}: C:/{exe}  {executable_tags(details)}".rstrip())
+            shown.append(exe)
+        return shown
+
+    def executable_details(self, executables):
+        # PE metadata per executable, only read again when one changed,
+        # given in order while the executables are still being listed
+        cache_file = os.path.join(self.prefix, "pe.json")
+        try:
+            with open(cache_file, encoding="utf-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = {}
+        details = {}
+        pending = []
+        pool = None
+        complete = False
+        try:
+            for exe in executables:
+                path = os.path.join(self.prefix, "drive_c", exe)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    pending.append((exe, {}, None))
+                    continue
+                entry = cached.get(exe)
+                if entry and entry["size"] == stat.st_size and \
+                        entry["mtime"] == stat.st_mtime_ns:
+                    pending.append((exe, entry, None))
+                else:
+                    if pool is None:
+                        from concurrent.futures import ThreadPoolExecutor
+                        pool = ThreadPoolExecutor()
+                    pending.append((exe, {
+                        "size": stat.st_size, "mtime": stat.st_mtime_ns
+                    }, pool.submit(read_pe_details, path)))
+                # Give what is ready, but only read ahead a limited amount
+                while pending and (pending[0][2] is None or len(
+                        pending) > 64 or pending[0][2].done()):
+                    yield self.pe_entry(details, *pending.pop(0))
+            while pending:
+                yield self.pe_entry(details, *pending.pop(0))
+            complete = True
+        finally:
+            if pool:
+                # Reading ahead is no longer needed when stopped early
+                for _, _, future in pending:
+                    if future:
+                        future.cancel()
+                pool.shutdown()
+            merged = {**cached, **details}
+            if complete:
+                merged = {exe: entry for exe, entry in merged.items()
+                          if exe in details or os.path.isfile(
+                              os.path.join(self.prefix, "drive_c", exe))}
+            if merged != cached:
+                try:
+                    with open(f"{cache_file}.tmp", "w",
+                              encoding="utf-8") as f:
+                        json.dump(merged, f)
+                    os.replace(f"{cache_file}.tmp", cache_file)
+                except OSError:
+                    pass
+
+    def pe_entry(self, details, exe, entry, future):
+        if future:
+            entry.update(future.result())
+        if entry:
+            details[exe] = entry
+        return exe, entry
+
+    def is_noise(self, exe):
+        name = os.path.basename(exe).lower()
+        return any(fnmatch.fnmatch(name, pattern.lower())
+                   for pattern in self.read_setting("noise", NOISE))
+
+    def menu_shortcuts(self, include_all):
+        # Shortcut file names and contents for the link and chosen programs
+        locations = [self.link_location] if self.link_location else []
+        chosen = CONFIG.carafe(self.name).get("shortcuts", [])
+        if include_all:
+            chosen = self.list_executables()
+        for loc in chosen:
+            loc = loc.strip().replace("\\", "/")
+            if loc.startswith("C:"):
+                loc = loc.replace("C:", "", 1)
+            loc = loc.lstrip("/")
+            if loc not in locations:
+                locations.append(loc)
+        icons = self.shortcut_icons(locations)
+        shortcuts = {}
+        for loc in locations:
+            if loc == self.link_location:
+                name, item = self.name, f"carafe-{self.name}.desktop"
+                contents = self.carafe_shortcut("link", icon=icons.get(loc))
+            else:
+                program = os.path.splitext(os.path.basename(loc))[0]
+                slug = re.sub(r"[^\w.-]+", "-", os.path.splitext(loc)[0])
+                name = f"{self.name} {program}"
+                item = f"carafe-{self.name}-{slug.strip('-')}.desktop"
+                contents = self.carafe_shortcut(
+                    loc, name=name, icon=icons.get(loc))
+            shortcuts[item] = f"{contents}X-Carafe={self.name}\n"
+        return shortcuts
+
+    def shortcut_icons(self, locations):
+        # Icons are only extracted again when the executable changed
+        folder = os.path.join(self.prefix, "icons")
+        cache_file = os.path.join(folder, "icons.json")
+        try:
+            with open(cache_file, encoding="utf-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = {}
+        icons = {}
+        for loc in locations:
+            try:
+                mtime = os.stat(
+                    os.path.join(self.prefix, "drive_c", loc)).st_mtime_ns
+            except OSError:
+                continue
+            entry = cached.get(loc)
+            if not entry or entry["mtime"] != mtime or entry["icon"] and \
+                    not os.path.isfile(os.path.join(folder, entry["icon"])):
+                import hashlib
+                name = hashlib.sha1(loc.encode()).hexdigest()[:16]
+                entry = {"mtime": mtime, "icon": extract_icon(
+                    os.path.join(self.prefix, "drive_c", loc), folder, name)}
+            icons[loc] = entry
+        if icons != cached:
             try:
-                chosen_app = int(chosen_app)
-            except ValueError:
-                chosen_app = -1
-        if chosen_app == "link":
-            return "link"
-        return executables[chosen_app]
-
-    def carafe_shortcut(self, loc):
+                os.makedirs(folder, exist_ok=True)
+                with open(f"{cache_file}.tmp", "w", encoding="utf-8") as f:
+                    json.dump(icons, f)
+                os.replace(f"{cache_file}.tmp", cache_file)
+            except OSError:
+                pass
+        return {loc: os.path.join(folder, entry["icon"])
+                for loc, entry in icons.items() if entry["icon"]}
+
+    def carafe_shortcut(self, loc, name=None, icon=None):
         carafe_dir = os.path.abspath(os.path.dirname(sys.argv[0]))
         carafe_exec = os.path.join(carafe_dir, os.path.basename(sys.argv[0]))
         if loc == "link":
             command = f"{carafe_exec} {self.name} start"
         else:
             command = f"{carafe_exec} {self.name} start -l \"{loc}\""
-        return "#!/usr/bin/env xdg-open\n" \
+        contents = "#!/usr/bin/env xdg-open\n" \
             "[Desktop Entry]\n" \
-            f"Name={self.name}\n" \
+            f"Name={name or self.name}\n" \
             "Type=Application\n" \
             f"Exec={command}\n"
+        if icon:
+            contents += f"Icon={icon}\n"
+        return contents
 
     def wine_shortcut(self, loc):
         if loc == "link":
@@ -470,11 +3287,439 @@ class Carafe:
             f"Path={path}\n"
 
 
-def main():
+def program_log(name):
+    # Log file of a program of a 'run-group', next to the log of the carafe
+    return "log.group-" + re.sub(r"[^\w.-]", "-", name)
+
+
+# Program of a 'run-group', optionally restarted after it crashed
+class GroupProgram:
+
+    def __init__(self, spec, logs, tagged):
+        carafe = Carafe(str(spec.get("carafe", "")))
+        carafe.exists()
+        if spec.get("location"):
+            location = carafe.try_to_sanitize_location(spec["location"])
+        else:
+            location = carafe.require_link()
+        check_for_tool("wine", carafe.wine)
+        path = os.path.join(carafe.prefix, "drive_c", location)
+        self.name = spec.get("name") or \
+            f"{carafe.name}:{os.path.basename(location)}"
+        self.command = shlex.split(carafe.wine) + [path] + [
+            str(arg) for arg in spec.get("arguments", [])]
+        self.cwd = os.path.dirname(path)
+        self.env = carafe.environment()
+        self.env["WINEDEBUG"] = "-all"
+        self.env.update({
+            str(key): str(value)
+            for key, value in (spec.get("env") or {}).items()})
+        self.restart = bool(spec.get("restart"))
+        self.output = None
+        if not tagged:
+            # Every program has its own log, so its output stays together
+            log = os.path.join(carafe.prefix, program_log(self.name))
+            if log not in logs:
+                logs[log] = carafe.open_log(
+                    f"run-group {self.name}", os.path.basename(log))
+            self.output = logs[log]
+        self.process = None
+        self.stopping = False
+
+    async def run(self):
+        import asyncio
+        crashes = 0
+        while True:
+            started = time.monotonic()
+            self.process = await asyncio.create_subprocess_exec(
+                *self.command, stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                cwd=self.cwd, env=self.env, start_new_session=True,
+                limit=1024 * 1024)
+            print(f"[{self.name}] started", flush=True)
+            while True:
+                if self.output:
+                    data = await self.process.stdout.read(65536)
+                else:
+                    try:
+                        data = await self.process.stdout.readline()
+                    except ValueError:
+                        continue
+                if not data:
+                    break
+                self.write(data)
+            code = await self.process.wait()
+            print(f"[{self.name}] exited with code {code}", flush=True)
+            if self.stopping or not self.restart or code == 0:
+                return code
+            # Programs that keep crashing are restarted less often
+            if time.monotonic() - started > 60:
+                crashes = 0
+            crashes += 1
+            delay = min(2 ** crashes, 60)
+            print(f"[{self.name}] restarting in {delay} seconds", flush=True)
+            await asyncio.sleep(delay)
+
+    def write(self, data):
+        if self.output:
+            self.output.write(data)
+        else:
+            sys.stdout.buffer.write(f"[{self.name}] ".encode() + data)
+            sys.stdout.flush()
+
+    def stop(self, sig):
+        self.stopping = True
+        if self.process and self.process.returncode is None:
+            with contextlib.suppress(OSError):
+                os.killpg(self.process.pid, sig)
+
+
+async def supervise_group(programs):
+    import asyncio
+    import signal
+    loop = asyncio.get_running_loop()
+    tasks = [asyncio.ensure_future(program.run()) for program in programs]
+
+    def shutdown():
+        print("Stopping all programs of the group", flush=True)
+        for program, task in zip(programs, tasks):
+            if program.process and program.process.returncode is None:
+                program.stop(signal.SIGTERM)
+                loop.call_later(10, program.stop, signal.SIGKILL)
+            else:
+                task.cancel()
+    for sig in [signal.SIGINT, signal.SIGTERM]:
+        loop.add_signal_handler(sig, shutdown)
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    return int(any(result != 0 for result in results))
+
+
+def run_group(args):
+    parser = argparse.ArgumentParser(
+        prog="carafe run-group", usage="carafe run-group <group>",
+        description="Use 'run-group' to start all programs of a group in the "
+                    "config at once, Ctrl-C stops all of them together")
+    parser.add_argument("group", help="Name of the group in the config")
+    parser.add_argument(
+        "-t", "--tagged", action="store_true",
+        help="Print the output of all programs tagged with their name, "
+             "instead of writing it to a log per program in their carafe")
+    args = parser.parse_args(args)
+    specs = CONFIG.get("groups", {}).get(args.group)
+    if not isinstance(specs, list) or not specs or not all(
+            isinstance(spec, dict) for spec in specs):
+        raise CarafeError(
+            f"There is no group named '{args.group}' in '{CONFIG_FILE}'\n"
+            "A group is a list of objects with a 'carafe' and optionally "
+            "a 'location', 'arguments', 'name', 'env' and 'restart'")
+    logs = {}
+    programs = [GroupProgram(spec, logs, args.tagged) for spec in specs]
+    import asyncio
+    try:
+        code = asyncio.run(supervise_group(programs))
+    finally:
+        for log in logs.values():
+            log.close()
+    sys.exit(code)
+
+
+# Manifest provisioning, carafes are handled in parallel, steps in order
+def manifest_steps(spec):
+    steps = [("create", "create", {
+        "arch": spec.get("arch"),
+        "from_template": spec.get("template", False)})]
+    for verb in spec.get("winetricks", []):
+        steps.append((f"winetricks:{verb}", "winetricks", {
+            "arguments": ["-q", verb]}))
+    for executable in spec.get("install", []):
+        steps.append((f"install:{executable}", "install", {
+            "executable": os.path.expanduser(executable)}))
+    if spec.get("link"):
+        steps.append((f"link:{spec['link']}", "link", {
+            "location": spec["link"]}))
+    for shortcut in spec.get("shortcuts", []):
+        output_folder = os.path.expanduser(shortcut.get(
+            "output_folder", os.path.join("~", "Desktop")))
+        steps.append((
+            f"shortcut:{json.dumps(shortcut, sort_keys=True)}", "shortcut", {
+                "location": shortcut.get("location", "link"),
+                "output_folder": output_folder, "name": shortcut.get("name"),
+                "shortcut_type": shortcut.get("type", "carafe")}))
+    return steps
+
+
+def apply_carafe(name, spec, force):
+    # Any error only fails this carafe, the others are still set up
+    name = sanitize_name(name)
+    try:
+        return apply_steps(Carafe(name).name, spec, force)
+    except Exception as e:
+        return name, False, f"failed: {e}"
+
+
+def apply_steps(name, spec, force):
+    prefix = os.path.join(CONFIG_FOLDER, name)
+    state_file = os.path.join(prefix, "apply.json")
+    done = []
+    if not force:
+        try:
+            with open(state_file, encoding="utf-8") as f:
+                done = json.load(f)
+        except (OSError, ValueError):
+            pass
+    finished = 0
+    for step, command, options in manifest_steps(spec):
+        if step == "create" and os.path.isdir(prefix) or step in done:
+            continue
+        print(f"[{name}] {step}", flush=True)
+        try:
+            carafe = Carafe(name)
+            if spec.get("wine"):
+                carafe.wine = spec["wine"]
+            getattr(carafe, command)(**options)
+        except CarafeError as e:
+            return name, False, f"failed at step '{step}': {e}"
+        except SystemExit:
+            return name, False, f"failed at step '{step}'"
+        finally:
+            if spec.get("wine") and os.path.isdir(prefix):
+                if CONFIG.carafe(name).get("wine") != spec["wine"]:
+                    CONFIG.modify(name, "wine", spec["wine"])
+            CONFIG.save()
+        done.append(step)
+        with open(state_file, "w", encoding="utf-8") as f:
+            json.dump(done, f)
+        finished += 1
+    return name, True, f"{finished} step(s) done"
+
+
+def apply_manifest(args):
+    parser = argparse.ArgumentParser(
+        prog="carafe apply", usage="carafe apply <manifest>",
+        description="Use 'apply' to create and configure all carafes "
+                    "described in a manifest file")
+    parser.add_argument("manifest", help="Location of the manifest file")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count(),
+        help="Amount of carafes to set up in parallel, default is all cores")
+    parser.add_argument(
+        "-f", "--force", action="store_true",
+        help="Run all steps again, even if they were completed before")
+    args = parser.parse_args(args)
+    try:
+        with open(args.manifest, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        raise CarafeError(f"The manifest could not be read: {e}") from e
+    if not isinstance(manifest, dict) or not all(
+            isinstance(spec, dict) for spec in manifest.values()):
+        raise CarafeError(
+            "The manifest should contain an object per carafe name")
+    failed = False
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=max(args.jobs, 1)) as pool:
+        results = [pool.submit(apply_carafe, name, spec, args.force)
+                   for name, spec in manifest.items()]
+        for result in results:
+            name, success, message = result.result()
+            print(f"{name}: {message}")
+            failed = failed or not success
+    sys.exit(1 if failed else 0)
+
+
+# Commands the daemon answers, options that need the terminal or timings
+# of the current process are always handled by the CLI itself
+DAEMON_COMMANDS = ["list", "info", "start", "link"]
+DAEMON_LOCAL_OPTIONS = [
+    "-h", "--help", "--timings", "-a", "--ask", "-k", "--keep-log", "-v",
+    "--verbose", "--wait", "-w", "--warm"]
+
+
+# Optional background process that keeps the config, parser and indexes
+# in memory and answers commands over a unix socket with JSON lines
+class Daemon:
+
+    def __init__(self):
+        self.parser = build_parser()
+        self.launch = None
+
+    def serve(self):
+        import signal
+        import socket
+        if daemon_request({"ping": True}):
+            raise CarafeError("The carafe daemon is already running")
+        with contextlib.suppress(OSError):
+            os.remove(DAEMON_SOCKET)
+        os.makedirs(CONFIG_FOLDER, exist_ok=True)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            server.bind(DAEMON_SOCKET)
+        finally:
+            os.umask(umask)
+        server.listen()
+        server.settimeout(10)
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        print(f"The carafe daemon is listening on '{DAEMON_SOCKET}'")
+        sys.stdout.flush()
+        try:
+            while True:
+                try:
+                    connection, _ = server.accept()
+                except socket.timeout:
+                    continue
+                with connection, connection.makefile("rwb") as stream:
+                    connection.settimeout(10)
+                    try:
+                        request = json.loads(stream.readline())
+                    except (OSError, ValueError):
+                        continue
+                    if request.get("stop"):
+                        break
+                    response = self.handle(request)
+                    with contextlib.suppress(OSError):
+                        stream.write(f"{json.dumps(response)}\n".encode())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            with contextlib.suppress(OSError):
+                os.remove(DAEMON_SOCKET)
+
+    def handle(self, request):
+        if request.get("ping"):
+            return {"pong": True}
+        global TIMINGS
+        TIMINGS = Timings()
+        CONFIG.refresh()
+        environ = dict(os.environ)
+        cwd = os.getcwd()
+        program = sys.argv[0]
+        output = io.StringIO()
+        code = 0
+        self.launch = None
+        import builtins
+        ask = builtins.input
+
+        def no_questions(*_args):
+            raise EOFError("the daemon can't ask questions")
+        builtins.input = no_questions
+        try:
+            os.environ.clear()
+            os.environ.update(request["env"])
+            os.chdir(request["cwd"])
+            sys.argv[0] = request["program"]
+            args = list(request["args"])
+            carafe_name = sanitize_name(args.pop(0))
+            with contextlib.redirect_stdout(output), \
+                    contextlib.redirect_stderr(output):
+                try:
+                    if carafe_name == "list":
+                        list_carafes(args)
+                    options = vars(self.parser.parse_args(args))
+                    sub = options.pop("sub")
+                    options.pop("timings")
+                    carafe = Carafe(carafe_name)
+                    try:
+                        getattr(carafe, sub)(**options)
+                    finally:
+                        CONFIG.save()
+                except CarafeError as e:
+                    print(e)
+                    code = 1
+                except SystemExit as e:
+                    if isinstance(e.code, str):
+                        print(e.code)
+                    code = e.code if isinstance(e.code, int) else int(
+                        e.code is not None)
+        except Exception:
+            # Questions and unexpected errors are left to the CLI
+            CONFIG.changes = []
+            CONFIG.config = None
+            return {"fallback": True}
+        finally:
+            builtins.input = ask
+            os.environ.clear()
+            os.environ.update(environ)
+            os.chdir(cwd)
+            sys.argv[0] = program
+        response = {"output": output.getvalue(), "code": code}
+        if self.launch:
+            response["exec"] = self.launch
+        return response
+
+
+def run_daemon(args):
+    parser = argparse.ArgumentParser(
+        prog="carafe daemon", usage="carafe daemon",
+        description="Use 'daemon' to answer 'list', 'info', 'start' and "
+                    "'link' from a background process, which is faster")
+    parser.add_argument(
+        "--stop", action="store_true", help="Stop the running daemon")
+    args = parser.parse_args(args)
+    if args.stop:
+        if daemon_request({"stop": True}, reply=False) is None:
+            raise CarafeError("The carafe daemon is not running")
+        sys.exit(0)
+    global DAEMON
+    DAEMON = Daemon()
+    DAEMON.serve()
+    sys.exit(0)
+
+
+def daemon_request(request, reply=True):
+    # Returns None if the daemon is not running or could not answer
+    if not os.path.exists(DAEMON_SOCKET):
+        return None
+    import socket
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            # A stuck daemon is skipped, so the command runs by itself
+            client.settimeout(1)
+            client.connect(DAEMON_SOCKET)
+            client.settimeout(30)
+            with client.makefile("rwb") as stream:
+                stream.write(f"{json.dumps(request)}\n".encode())
+                stream.flush()
+                if not reply:
+                    return {}
+                response = json.loads(stream.readline())
+    except (OSError, ValueError):
+        return None
+    if response.get("fallback"):
+        return None
+    return response
+
+
+def daemon_command(carafe_name, args):
+    # Linking without a location asks for it, which only the CLI can do
+    if args and args[0] == "link" and not any(
+            arg.startswith(("-l", "--location")) for arg in args[1:]):
+        return None
+    if carafe_name == "list" or args and args[0] in DAEMON_COMMANDS:
+        if not any(arg in DAEMON_LOCAL_OPTIONS for arg in args):
+            return daemon_request({
+                "args": [carafe_name] + args, "cwd": os.getcwd(),
+                "env": dict(os.environ), "program": sys.argv[0]})
+    return None
+
+
+SUB_COMMANDS = [
+    "create", "install", "start", "preload", "rename", "copy", "export",
+    "remove", "info", "link", "shortcut", "log", "regedit", "reg",
+    "winecfg", "winetricks", "warm", "stop", "stats", "gc"]
+
+
+def build_parser(only=None):
+    # Only the parser of the requested sub-command is built when known
+
+    def wanted(name):
+        return only is None or only == name
     # Prepare the main parser
     description = f"Welcome to carafe {__version__}\n" \
         "carafe is a tiny management tool for wine bottles/carafes.\n"
-    usage = "carafe {<carafe_name>,list} <sub_command>"
+    usage = "carafe {<carafe_name>,list,find,template,apply,dedup,import," \
+        "daemon,run-group,shortcut-sync,gc} <sub_command>"
     parser = argparse.ArgumentParser(
         usage=usage, description=description,
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -484,145 +3729,376 @@ def main():
     sub = parser.add_subparsers(
         title="sub-commands", dest="sub",
         description="All the valid sub-commands to manage the carafes")
+    noise_help = "Hide executables that are rarely started, such as " \
+        "uninstallers, see 'hide_noise' in README"
     # Create
-    sub_create = sub.add_parser(
-        "create", help="Create a new carafe",
-        usage="carafe <carafe_name> create",
-        description="Use 'create' to make a new carafe, you should start here")
-    sub_create.add_argument(
-        "--arch", help="Change the default arch, e.g. to win32")
-    sub_create.add_argument(
-        "-v", "--verbose", action="store_true",
-        help="Print the wine log to the screen (log file is always written)")
+    if wanted("create"):
+        sub_create = sub.add_parser(
+            "create", help="Create a new carafe",
+            usage="carafe <carafe_name> create",
+            description="Use 'create' to make a new carafe, you should start "
+                        "here")
+        sub_create.add_argument(
+            "--arch", help="Change the default arch, e.g. to win32")
+        sub_create.add_argument(
+            "-t", "--from-template", action="store_true",
+            help="Clone a prefix made with 'carafe template build' if "
+                 "available")
+        sub_create.add_argument(
+            "-v", "--verbose", action="store_true",
+            help="Print the wine log to the screen (log file is always "
+                 "written)")
     # Install
-    sub_install = sub.add_parser(
-        "install", help="Install software to the carafe",
-        usage="carafe <carafe_name> install",
-        description="Use 'install' to run an ext"
-                    "ernal exe/msi inside the carafe")
-    sub_install.add_argument(
-        "-e", "--executable",
-        help="Location of the external executable to run inside the carafe")
-    sub_install.add_argument(
-        "-v", "--verbose", action="store_true",
-        help="Print the wine log to the screen (log file is always written)")
+    if wanted("install"):
+        sub_install = sub.add_parser(
+            "install", help="Install software to the carafe",
+            usage="carafe <carafe_name> install",
+            description="Use 'install' to run an external exe/msi "
+                        "inside the carafe")
+        sub_install.add_argument(
+            "-e", "--executable",
+            help="Location of the external executable to run inside the "
+                 "carafe")
+        sub_install.add_argument(
+            "-v", "--verbose", action="store_true",
+            help="Print the wine log to the screen (log file is always "
+                 "written)")
     # Start
-    sub_start = sub.add_parser(
-        "start", help="Start an installed program",
-        usage="carafe <carafe_name> start",
-        description="Use 'start' to start a program inside an existing carafe")
-    sub_start.add_argument(
-        "-k", "--keep-log", action="store_true",
-        help="Keep the wine log (can be multiple GBs and will slow down wine)")
-    sub_start.add_argument(
-        "-v", "--verbose", action="store_true",
-        help="Keep the wine log and print it to screen (will slow down wine)")
-    sub_start.add_argument(
-        "-a", "--ask", action="store_true",
-        help="Instead of starting the link or --location, ask for the path")
-    sub_start.add_argument(
-        "-l", "--location",
-        help="Location of the executable inside the carafe to start")
-    sub_start.add_argument(
-        "arguments", nargs=argparse.REMAINDER,
-        help="Any arguments will directly be passed to the started executable")
+    if wanted("start"):
+        sub_start = sub.add_parser(
+            "start", help="Start an installed program",
+            usage="carafe <carafe_name> start",
+            description="Use 'start' to start a program inside an existing "
+                        "carafe")
+        sub_start.add_argument(
+            "-k", "--keep-log", action="store_true",
+            help="Keep the wine log (limited in size, see 'log_size' in "
+                 "README)")
+        sub_start.add_argument(
+            "-v", "--verbose", action="store_true",
+            help="Keep the wine log and print it to screen (will slow down "
+                 "wine)")
+        sub_start.add_argument(
+            "-a", "--ask", action="store_true",
+            help="Instead of starting the link or --location, ask for the "
+                 "path")
+        sub_start.add_argument(
+            "-l", "--location",
+            help="Location of the executable inside the carafe to start")
+        sub_start.add_argument(
+            "--hide-noise", action="store_true", help=noise_help)
+        sub_start.add_argument(
+            "--wait", action="store_true",
+            help="Keep carafe running until the program exits, instead of "
+                 "replacing carafe with wine, to record the exit timing")
+        sub_start.add_argument(
+            "-w", "--warm", action="store_true",
+            help="Reuse the wineserver of 'warm', or warm it up first")
+        sub_start.add_argument(
+            "-p", "--preload", action="store_true",
+            help="Read the program and its dlls into memory first, see "
+                 "'preload'")
+        sub_start.add_argument(
+            "arguments", nargs=argparse.REMAINDER,
+            help="Any arguments will directly be passed to the started "
+                 "executable")
+    # Preload
+    if wanted("preload"):
+        sub_preload = sub.add_parser(
+            "preload", help="Read a program into the page cache",
+            usage="carafe <carafe_name> preload",
+            description="Use 'preload' to read the linked program, the dlls "
+                        "next to it and the dlls it imports into memory, "
+                        "to speed up starting it from slow storage")
+        sub_preload.add_argument(
+            "-l", "--location",
+            help="Location of the executable inside the carafe to preload")
+        sub_preload.add_argument(
+            "-r", "--record", action="store_true",
+            help="Record the files used by the running program, and preload "
+                 "exactly those files from now on")
     # Rename
-    sub_rename = sub.add_parser(
-        "rename", help="Rename an existing carafe",
-        usage="carafe <carafe_name> rename <new_name>",
-        description="Use 'rename' to change the name of an existing carafe")
-    sub_rename.add_argument("newname", help="New name of the carafe")
+    if wanted("rename"):
+        sub_rename = sub.add_parser(
+            "rename", help="Rename an existing carafe",
+            usage="carafe <carafe_name> rename <new_name>",
+            description="Use 'rename' to change the name of an existing "
+                        "carafe")
+        sub_rename.add_argument("newname", help="New name of the carafe")
     # Copy
-    sub_copy = sub.add_parser(
-        "copy", help="Copy an existing carafe",
-        usage="carafe <carafe_name> copy <new_name>",
-        description="Use 'copy' to duplicate an existing carafe to a new one")
-    sub_copy.add_argument("newname", help="Name of the new carafe")
+    if wanted("copy"):
+        sub_copy = sub.add_parser(
+            "copy", help="Copy an existing carafe",
+            usage="carafe <carafe_name> copy <new_name>",
+            description="Use 'copy' to duplicate an existing carafe to a new "
+                        "one")
+        sub_copy.add_argument("newname", help="Name of the new carafe")
+        sub_copy.add_argument(
+            "-m", "--mode", choices=["reflink", "hardlink", "full"],
+            default="reflink",
+            help="Share file data with reflinks where supported (default), "
+                 "hardlink read-only files and copy the rest, or always make "
+                 "a full copy")
+    # Export
+    if wanted("export"):
+        sub_export = sub.add_parser(
+            "export", help="Export a carafe to a single file",
+            usage="carafe <carafe_name> export <file>",
+            description="Use 'export' to save a carafe and its config to a "
+                        "compressed file, which can be restored with "
+                        "'carafe import'")
+        sub_export.add_argument(
+            "file", help="Location of the export, or '-' to write to stdout")
+        sub_export.add_argument(
+            "-i", "--incremental", metavar="BASE",
+            help="Only store the files that changed since the export BASE")
     # Remove
-    sub.add_parser(
-        "remove", help="Remove a carafe",
-        usage="carafe <carafe_name> remove",
-        description="Use 'remove' to delete an existing carafe")
+    if wanted("remove"):
+        sub.add_parser(
+            "remove", help="Remove a carafe",
+            usage="carafe <carafe_name> remove",
+            description="Use 'remove' to delete an existing carafe")
     # Info
-    sub.add_parser(
-        "info", help="All info about a carafe",
-        usage="carafe <carafe_name> info",
-        description="Use 'info' to print all information about a carafe")
+    if wanted("info"):
+        sub_info = sub.add_parser(
+            "info", help="All info about a carafe",
+            usage="carafe <carafe_name> info",
+            description="Use 'info' to print all information about a carafe")
+        sub_info.add_argument(
+            "--hide-noise", action="store_true", help=noise_help)
     # Link
-    sub_link = sub.add_parser(
-        "link", help="Link a program to the carafe",
-        usage="carafe <carafe_name> link",
-        description="Use 'link' to connect the startup link (recommended)")
-    sub_link.add_argument(
-        "-l", "--location",
-        help="Location of the executable inside the carafe to link")
+    if wanted("link"):
+        sub_link = sub.add_parser(
+            "link", help="Link a program to the carafe",
+            usage="carafe <carafe_name> link",
+            description="Use 'link' to connect the startup link (recommended)")
+        sub_link.add_argument(
+            "-l", "--location",
+            help="Location of the executable inside the carafe to link")
+        sub_link.add_argument(
+            "--hide-noise", action="store_true", help=noise_help)
     # Shortcut
-    sub_shortcut = sub.add_parser(
-        "shortcut", help="Generate a desktop shortcut",
-        usage="carafe <carafe_name> shortcut",
-        description="Use 'shortcut' to create a .desktop shortcut to a carafe")
-    location_help = "Location of the executable inside the carafe to " \
-        "shortcut, normally a path, but can be set to 'link' as well"
-    sub_shortcut.add_argument(
-        "-l", "--location",
-        help=location_help)
-    sub_shortcut.add_argument(
-        "-o", "--output-folder",
-        default=os.path.join(os.path.expanduser("~"), "Desktop"),
-        help="Which folder to place the shortcut, default is the user desktop")
-    sub_shortcut.add_argument(
-        "-n", "--name",
-        help="Name of the new shortcut, default is the name of the carafe")
-    sub_shortcut.add_argument(
-        "-t", "--type", choices=["carafe", "wine"],
-        help="The type of shortcut to make")
+    if wanted("shortcut"):
+        sub_shortcut = sub.add_parser(
+            "shortcut", help="Generate a desktop shortcut",
+            usage="carafe <carafe_name> shortcut",
+            description="Use 'shortcut' to create a .desktop shortcut to a "
+                        "carafe")
+        location_help = "Location of the executable inside the carafe to " \
+            "shortcut, normally a path, but can be set to 'link' as well"
+        sub_shortcut.add_argument(
+            "-l", "--location",
+            help=location_help)
+        sub_shortcut.add_argument(
+            "-o", "--output-folder",
+            default=os.path.join(os.path.expanduser("~"), "Desktop"),
+            help="Which folder to place the shortcut, default is the user "
+                 "desktop")
+        sub_shortcut.add_argument(
+            "-n", "--name",
+            help="Name of the new shortcut, default is the name of the carafe")
+        sub_shortcut.add_argument(
+            "-t", "--type", choices=["carafe", "wine"],
+            dest="shortcut_type", help="The type of shortcut to make")
+        sub_shortcut.add_argument(
+            "--hide-noise", action="store_true", help=noise_help)
     # Log
-    sub.add_parser(
-        "log", help="Show the last command output",
-        usage="carafe <carafe_name> log <new_name>",
-        description="Use 'log' to show the output of the last command")
+    if wanted("log"):
+        sub_log = sub.add_parser(
+            "log", help="Show the last command output",
+            usage="carafe <carafe_name> log",
+            description="Use 'log' to show the output of the last command")
+        sub_log.add_argument(
+            "-n", "--tail", type=int, metavar="N",
+            help="Only show the last N (matching) lines of the log")
+        sub_log.add_argument(
+            "-f", "--follow", action="store_true",
+            help="Keep showing new lines as they are written, until Ctrl-C")
+        sub_log.add_argument(
+            "-g", "--grep", metavar="PATTERN",
+            help="Only show lines matching this regular expression")
+        sub_log.add_argument(
+            "-c", "--channel", action="append",
+            help="Only show lines of a wine debug class or channel, "
+                 "e.g. 'err', 'd3d' or 'fixme:d3d' (can be repeated)")
+        sub_log.add_argument(
+            "-s", "--summary", action="store_true",
+            help="Count the messages per debug class and channel")
+        sub_log.add_argument(
+            "-a", "--all", action="store_true", dest="all_sessions",
+            help="Also show the kept output of earlier commands")
+        sub_log.add_argument(
+            "-p", "--program", metavar="NAME",
+            help="Show the log of a program started by 'run-group' instead")
     # Regedit
-    sub_regedit = sub.add_parser(
-        "regedit", help="Run regedit",
-        usage="carafe <carafe_name> regedit",
-        description="Use 'regedit' to edit the windows registry")
-    sub_regedit.add_argument(
-        "-v", "--verbose", action="store_true",
-        help="Print the wine log to the screen (log file is always written)")
+    if wanted("regedit"):
+        sub_regedit = sub.add_parser(
+            "regedit", help="Run regedit",
+            usage="carafe <carafe_name> regedit",
+            description="Use 'regedit' to edit the windows registry")
+        sub_regedit.add_argument(
+            "-v", "--verbose", action="store_true",
+            help="Print the wine log to the screen (log file is always "
+                 "written)")
+    # Reg
+    if wanted("reg"):
+        sub_reg = sub.add_parser(
+            "reg", help="Read or change the registry",
+            usage="carafe <carafe_name> reg {get,set,list,export} <key>",
+            description="Use 'reg' to read or change registry values without "
+                        "starting wine")
+        sub_reg.add_argument(
+            "action", choices=["get", "set", "list", "export"],
+            help="Show a value, change a value, list the subkeys and values "
+                 "of a key, or export a key to the .reg format")
+        sub_reg.add_argument(
+            "key", help="Registry key, e.g. HKCU/Software/Wine/DllOverrides")
+        sub_reg.add_argument(
+            "name", nargs="?", help="Name of the value, or @ for the default")
+        sub_reg.add_argument("data", nargs="?", help="New data of the value")
+        sub_reg.add_argument(
+            "-t", "--type", choices=["string", "expand", "dword"],
+            default="string", dest="value_type",
+            help="Type of the new data, default is string")
+        sub_reg.add_argument(
+            "-a", "--all", action="store_true", dest="all_carafes",
+            help="Run it for all carafes, with their names in front of the "
+                 "output")
     # Winecfg
-    sub_winecfg = sub.add_parser(
-        "winecfg", help="Run winecfg",
-        usage="carafe <carafe_name> winecfg",
-        description="Use 'winecfg' to configure all wine settings")
-    sub_winecfg.add_argument(
-        "-v", "--verbose", action="store_true",
-        help="Print the wine log to the screen (log file is always written)")
+    if wanted("winecfg"):
+        sub_winecfg = sub.add_parser(
+            "winecfg", help="Run winecfg",
+            usage="carafe <carafe_name> winecfg",
+            description="Use 'winecfg' to configure all wine settings")
+        sub_winecfg.add_argument(
+            "-v", "--verbose", action="store_true",
+            help="Print the wine log to the screen (log file is always "
+                 "written)")
     # Winetricks
-    sub_tricks = sub.add_parser(
-        "winetricks", help="Run winetricks",
-        usage="carafe <carafe_name> winetricks <optional_arguments>",
-        description="Use 'winetricks' to install winetricks components")
-    sub_tricks.add_argument(
-        "-v", "--verbose", action="store_true",
-        help="Print the wine log to the screen (log file is always written)")
-    sub_tricks.add_argument(
-        "arguments", nargs=argparse.REMAINDER,
-        help="Any arguments will directly be passed to winetricks")
+    if wanted("winetricks"):
+        sub_tricks = sub.add_parser(
+            "winetricks", help="Run winetricks",
+            usage="carafe <carafe_name> winetricks <optional_arguments>",
+            description="Use 'winetricks' to install winetricks components")
+        sub_tricks.add_argument(
+            "-v", "--verbose", action="store_true",
+            help="Print the wine log to the screen (log file is always "
+                 "written)")
+        sub_tricks.add_argument(
+            "arguments", nargs=argparse.REMAINDER,
+            help="Any arguments will directly be passed to winetricks")
+    # Warm
+    if wanted("warm"):
+        sub_warm = sub.add_parser(
+            "warm", help="Keep the wineserver running",
+            usage="carafe <carafe_name> warm",
+            description="Use 'warm' to start a persistent wineserver, so "
+                        "programs in the carafe start faster")
+        sub_warm.add_argument(
+            "-i", "--idle-timeout", type=int, default=600, metavar="SECONDS",
+            help="Stop the wineserver after no program ran for this many "
+                 "seconds, 0 means never, default is 600")
+        sub_warm.add_argument(
+            "-s", "--services", action="store_true",
+            help="Also start the wine services, such as services.exe")
+    # Stop
+    if wanted("stop"):
+        sub.add_parser(
+            "stop", help="Stop the wineserver",
+            usage="carafe <carafe_name> stop",
+            description="Use 'stop' to shut down the wineserver and all "
+                        "running programs of a carafe")
+    # Stats
+    if wanted("stats"):
+        sub.add_parser(
+            "stats", help="Show launch time statistics",
+            usage="carafe <carafe_name> stats",
+            description="Use 'stats' to show the percentiles of the recorded "
+                        "launch timings of a carafe")
+    # Gc
+    if wanted("gc"):
+        sub_gc = sub.add_parser(
+            "gc", help="Clean up temporary files and caches",
+            usage="carafe <carafe_name> gc",
+            description="Use 'gc' to report and remove temporary files, old "
+                        "logs, installer caches and shader caches, see "
+                        "'carafe gc' to clean up multiple carafes")
+        sub_gc.add_argument(
+            "-y", "--yes", action="store_true",
+            help="Actually remove the files instead of only reporting them")
+    # Timings for all sub-commands
+    for sub_parser in sub.choices.values():
+        sub_parser.add_argument(
+            "--timings", nargs="?", const="text", choices=["text", "json"],
+            help="Print the duration of each phase of the command to stderr")
+    return parser
+
+
+def main():
+    global CLI
+    CLI = True
+    try:
+        run_cli(sys.argv[1:])
+    except CarafeError as e:
+        print(e)
+        sys.exit(1)
+
+
+def run_cli(args):
     # Actually handle all the arguments
-    args = sys.argv[1:]
     if not args:
-        parser.print_help()
+        build_parser().print_help()
         sys.exit(0)
-    carafe_name = args.pop(0).replace(" ", "").replace("/", "-")
+    carafe_name = sanitize_name(args.pop(0))
+    response = daemon_command(carafe_name, args)
+    if response:
+        print(response["output"], end="")
+        if response.get("exec"):
+            launch = response["exec"]
+            replace_with_wine(
+                launch["executable"], launch["command"], launch["env"],
+                launch["cwd"])
+        sys.exit(response["code"])
     if carafe_name == "list":
-        list_carafes()
+        list_carafes(args)
+    if carafe_name == "find":
+        find_executables(args)
+    if carafe_name == "template":
+        manage_templates(args)
+    if carafe_name == "apply":
+        apply_manifest(args)
+    if carafe_name == "dedup":
+        dedup_carafes(args)
+    if carafe_name == "import":
+        import_carafe(args)
+    if carafe_name == "daemon":
+        run_daemon(args)
+    if carafe_name == "run-group":
+        run_group(args)
+    if carafe_name == "shortcut-sync":
+        sync_shortcuts(args)
+    if carafe_name == "gc":
+        gc_carafes(args)
+    only = None
+    if args and args[0] in SUB_COMMANDS:
+        if carafe_name not in ["-h", "--help"]:
+            only = args[0]
+    parser = build_parser(only)
     subargs = parser.parse_args(args)
     if not subargs.sub or carafe_name in ["-h", "--help"]:
         parser.print_help()
         sys.exit(0)
     # Call the correct subcommand on the Carafe class
+    options = vars(subargs)
+    sub = options.pop("sub")
+    TIMINGS.style = options.pop("timings")
     carafe = globals()["Carafe"](carafe_name)
-    getattr(carafe, subargs.sub)(subargs)
+    try:
+        getattr(carafe, sub)(**options)
+    finally:
+        CONFIG.save()
+        if TIMINGS.style:
+            TIMINGS.report(TIMINGS.style, sub)
 
 
 # Main startup steps